@@ -1,99 +1,102 @@
-from copy import deepcopy
-
-from rich.highlighter import JSONHighlighter
-
-from swagger_client.models import ActionTypeEnum
-from align_system.utils import logging
+import json
+import logging
 
+# A standard logger rather than align_system's, which pulls in rich at
+# import; messages go to whichever handlers are set up once align_system loads
 log = logging.getLogger(__name__)
-JSON_HIGHLIGHTER = JSONHighlighter()
-
-def filter_actions(current_state, available_actions) -> list:
 
-    scenario_complete = current_state.scenario_complete
-
-    # Tracking these to prevent getting stuck in a loop
-    noop_actions = []
-
-    last_scene_id = None
+# swagger_client.models.ActionTypeEnum values, which are plain strings;
+# spelled out so filtering doesn't import swagger_client
+APPLY_TREATMENT = 'APPLY_TREATMENT'
+CHECK_ALL_VITALS = 'CHECK_ALL_VITALS'
+CHECK_PULSE = 'CHECK_PULSE'
+CHECK_RESPIRATION = 'CHECK_RESPIRATION'
+CHECK_BLOOD_OXYGEN = 'CHECK_BLOOD_OXYGEN'
+MOVE_TO_EVAC = 'MOVE_TO_EVAC'
+TAG_CHARACTER = 'TAG_CHARACTER'
+
+CHARACTER_ACTION_TYPES = {APPLY_TREATMENT,
+                          CHECK_ALL_VITALS,
+                          CHECK_PULSE,
+                          CHECK_RESPIRATION,
+                          MOVE_TO_EVAC,
+                          TAG_CHARACTER,
+                          CHECK_BLOOD_OXYGEN}
+CHECK_ACTION_TYPES = {CHECK_ALL_VITALS,
+                      CHECK_PULSE,
+                      CHECK_RESPIRATION,
+                      CHECK_BLOOD_OXYGEN}
+
+
+def _action_key(action, **overrides):
+    # Hashable stand-in for action equality (swagger models compare all
+    # their fields)
+    action_dict = action.to_dict()
+    action_dict.update(overrides)
+    return json.dumps(action_dict, sort_keys=True, default=str)
+
+
+def filter_actions(current_state, available_actions, noop_actions=None) -> list:
+    '''
+    Filter out actions that can't apply to the current state. noop_actions
+    are actions already taken with no change in the scenario state;
+    they're filtered out to prevent getting stuck in a loop.
+    '''
+    # Facts about the state are computed once rather than per action
+    has_characters = len(current_state.characters) > 0
+    has_untagged_characters = any(c.tag is None and not c.unseen
+                                  for c in current_state.characters)
+    has_unvisited_characters = any(not c.unseen and (c.visited is None or not c.visited)
+                                   for c in current_state.characters)
+
+    supply_quantities = {}
+    for s in current_state.supplies:
+        # Only the first supply of each type counts
+        supply_quantities.setdefault(s.type, s.quantity)
+
+    noop_keys = set()
+    for noop_action in noop_actions or []:
+        noop_keys.add(_action_key(noop_action))
+        # HACK: In some cases the ADM can get stuck
+        # attempting to use the generic APPLY_TREATMENT
+        # action over and over to no affect
+        if noop_action.action_type == APPLY_TREATMENT:
+            noop_keys.add(_action_key(noop_action, parameters=None, character_id=None))
 
     available_actions_filtered = []
     for a in available_actions:
-        if len(current_state.characters) == 0:
+        if not has_characters and a.action_type in CHARACTER_ACTION_TYPES:
             # Restrict actions that require a character when
             # no characters exist
-            if a.action_type in {ActionTypeEnum.APPLY_TREATMENT,
-                                    ActionTypeEnum.CHECK_ALL_VITALS,
-                                    ActionTypeEnum.CHECK_PULSE,
-                                    ActionTypeEnum.CHECK_RESPIRATION,
-                                    ActionTypeEnum.MOVE_TO_EVAC,
-                                    ActionTypeEnum.TAG_CHARACTER,
-                                    ActionTypeEnum.CHECK_BLOOD_OXYGEN}:
-                log.debug("No characters in current state, not "
-                            "allowing {} action".format(a.action_type))
-                continue
-
-        if a.action_type == ActionTypeEnum.TAG_CHARACTER:
+            log.debug("No characters in current state, not "
+                      "allowing {} action".format(a.action_type))
+            continue
+
+        if a.action_type == TAG_CHARACTER and not has_untagged_characters:
             # Don't let ADM choose to tag a character unless there are
             # still untagged characters
-            untagged_characters = [c for c in current_state.characters
-                                    if c.tag is None and not c.unseen]
-            if len(untagged_characters) == 0:
-                log.debug("No untagged characters remaining, not "
-                            "allowing {} action".format(ActionTypeEnum.TAG_CHARACTER))
-                continue
-
-        unvisited_characters = [c for c in current_state.characters
-                                if not c.unseen and (c.visited is None or not c.visited)]
-        if a.action_type in {ActionTypeEnum.CHECK_ALL_VITALS,
-                                ActionTypeEnum.CHECK_PULSE,
-                                ActionTypeEnum.CHECK_RESPIRATION,
-                                ActionTypeEnum.CHECK_BLOOD_OXYGEN}:
-            if len(unvisited_characters) == 0:
-                log.debug("No unvisited characters remaining, not "
-                            "allowing {} action".format(a.action_type))
-                continue
+            log.debug("No untagged characters remaining, not "
+                      "allowing {} action".format(TAG_CHARACTER))
+            continue
+
+        if a.action_type in CHECK_ACTION_TYPES and not has_unvisited_characters:
+            log.debug("No unvisited characters remaining, not "
+                      "allowing {} action".format(a.action_type))
+            continue
 
         if (
-            a.action_type == ActionTypeEnum.APPLY_TREATMENT and
-            a.parameters is not None and 'treatment' in a.parameters
+            a.action_type == APPLY_TREATMENT and
+            a.parameters is not None and 'treatment' in a.parameters and
+            supply_quantities.get(a.parameters['treatment'], 0) <= 0
         ):
-            treatment_available = False
-            for s in current_state.supplies:
-                if a.parameters['treatment'] == s.type:
-                    if s.quantity > 0:
-                        treatment_available = True
-                    break
-
-            if not treatment_available:
-                log.debug("Insufficient supplies, not allowing "
-                            f"{ActionTypeEnum.APPLY_TREATMENT} action")
-                continue
-
-        is_a_noop_action = False
-        for noop_action in noop_actions:
-            if a == noop_action:
-                is_a_noop_action = True
-
-            # HACK: In some cases the ADM can get stuck
-            # attempting to use the generic APPLY_TREATMENT
-            # action over and over to no affect
-            if noop_action.action_type == ActionTypeEnum.APPLY_TREATMENT:
-                _tmp_noop_action = deepcopy(noop_action)
-
-                _tmp_noop_action.parameters = None
-                _tmp_noop_action.character_id = None
-
-                if a == _tmp_noop_action:
-                    is_a_noop_action = True
-                    log.debug("Handled case where ADM might be stuck "
-                                "applying treatment over and over to no "
-                                "effect, not allowing {} action".format(a.action_type))
-
-        if is_a_noop_action:
+            log.debug("Insufficient supplies, not allowing "
+                      f"{APPLY_TREATMENT} action")
+            continue
+
+        if noop_keys and _action_key(a) in noop_keys:
             log.debug("Already took this action and there was no "
-                        "change in the scenario state, not allowing "
-                        "{} action".format(a.action_type))
+                      "change in the scenario state, not allowing "
+                      "{} action".format(a.action_type))
             continue
 
         available_actions_filtered.append(a)
@@ -0,0 +1,305 @@
+from collections import namedtuple
+from copy import deepcopy
+import json
+import re
+import time
+
+from align_system.prompt_engineering.outlines_prompts import action_choice_json_schema
+from align_system.utils import adm_utils
+from outlines.samplers import GreedySampler
+from transformers import (
+    DynamicCache,
+    LogitsProcessor,
+    LogitsProcessorList,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextStreamer,
+)
+
+from guide_cache import get_guide, json_logits_processor
+from metrics import record_generation, span
+from prefix_cache import get_prefix_cache, prefix_cache_kwargs
+
+KDMA_DESCRIPTIONS_MAP = 'configs/prompt_engineering/kdma_descriptions.yml'
+REASONING_MAX_LENGTH = 512
+WHITESPACE_PATTERN = r"[ ]?"
+# Start of the response each choice is scored after in choice-only mode
+CHOICE_ONLY_PREFIX = '{"action_choice": '
+
+GenerationRun = namedtuple('GenerationRun', ['instance', 'prompt', 'scenario_state', 'available_actions'])
+
+
+def format_choices(scenario_state, available_actions):
+    # Same choice strings (and order) the ADM puts in its prompt and schema
+    return adm_utils.format_choices(
+        [a.unstructured for a in available_actions],
+        available_actions,
+        scenario_state
+    )
+
+
+def action_schema(choices):
+    return action_choice_json_schema(json.dumps(choices), REASONING_MAX_LENGTH)
+
+
+def supports_direct_generation(instance):
+    # Generating outside of top_level_choose_action only reproduces the
+    # ADM's output for greedy decoding. benchmarks.check_generation_parity
+    # checks that it does on the bundled datasets.
+    return isinstance(getattr(instance, 'sampler', None), GreedySampler)
+
+
+class RowwiseLogitsProcessor(LogitsProcessor):
+    '''
+    Applies a separate structured-generation processor to each row of a
+    batch so prompts with different action choices can share one generate
+    call
+    '''
+    def __init__(self, processors):
+        self.processors = processors
+
+    def __call__(self, input_ids, scores):
+        for i, processor in enumerate(self.processors):
+            scores[i:i + 1] = processor(input_ids[i:i + 1], scores[i:i + 1])
+        return scores
+
+
+def _logits_processor(instance, schemas):
+    if all(schema == schemas[0] for schema in schemas):
+        return json_logits_processor(instance.model.tokenizer, schemas[0], WHITESPACE_PATTERN)
+    return RowwiseLogitsProcessor([
+        json_logits_processor(instance.model.tokenizer, schema, WHITESPACE_PATTERN)
+        for schema in schemas])
+
+
+class _CallbackStreamer(TextStreamer):
+    def __init__(self, tokenizer, on_text):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.on_text = on_text
+
+    def on_finalized_text(self, text, stream_end=False):
+        self.on_text(text)
+
+
+class _StopOnEvent(StoppingCriteria):
+    def __init__(self, stop_event):
+        self.stop_event = stop_event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.stop_event.is_set()
+
+
+def _generate(instance, prompts, schemas, max_new_tokens, **generate_kwargs):
+    tokenizer = instance.model.tokenizer.tokenizer
+    model = instance.model.model
+
+    tokenizer.padding_side = 'left'
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    # Encoded by the ADM's own (outlines) tokenizer, with the tokenizer's
+    # default special tokens, so the model sees the same input ids as in
+    # top_level_choose_action
+    input_ids, attention_mask = instance.model.tokenizer.encode(prompts)
+    inputs = {'input_ids': input_ids.to(model.device),
+              'attention_mask': attention_mask.to(model.device)}
+
+    # Single prompts (e.g. re-running an edited prompt) reuse the KV state
+    # of the longest matching cached prompt prefix
+    use_prefix_cache = len(prompts) == 1
+    if use_prefix_cache:
+        generate_kwargs.update(prefix_cache_kwargs(model, inputs['input_ids'][0]))
+
+    # Speculative decoding only supports one prompt at a time. The prefix
+    # cache only holds the backbone's KV state; the draft model encodes the
+    # whole prompt itself. Greedy verification keeps the backbone's output.
+    draft_model = getattr(instance, 'draft_model', None)
+    if draft_model is not None and len(prompts) == 1:
+        generate_kwargs['assistant_model'] = draft_model
+
+    logits_processor = LogitsProcessorList([_logits_processor(instance, schemas)])
+    start = time.perf_counter()
+    with span('model_forward'):
+        output = model.generate(
+            **inputs,
+            logits_processor=logits_processor,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            pad_token_id=tokenizer.pad_token_id,
+            **generate_kwargs
+        )
+    seconds = time.perf_counter() - start
+
+    output_ids = output
+    if generate_kwargs.get('return_dict_in_generate'):
+        output_ids = output.sequences
+        if use_prefix_cache:
+            get_prefix_cache(model).store(inputs['input_ids'][0], output.past_key_values)
+
+    new_ids = output_ids[:, inputs['input_ids'].shape[1]:]
+    record_generation(model.name_or_path, int((new_ids != tokenizer.pad_token_id).sum()), seconds)
+    return tokenizer.batch_decode(new_ids, skip_special_tokens=True)
+
+
+def generate_json(instance, prompts, schemas, max_new_tokens):
+    '''
+    Greedy structured generation for a batch of prompts (one JSON schema per
+    prompt) in a single left-padded generate call on the ADM's transformer
+    backend
+    '''
+    return [json.loads(text) for text in _generate(instance, prompts, schemas, max_new_tokens)]
+
+
+def stream_json(instance, prompt, schema, max_new_tokens, on_text, stop_event):
+    '''
+    Like generate_json for a single prompt, passing decoded text to on_text
+    as it's generated. Returns None if stop_event is set before the
+    generation finishes.
+    '''
+    tokenizer = instance.model.tokenizer.tokenizer
+    text, = _generate(instance, [prompt], [schema], max_new_tokens,
+                      streamer=_CallbackStreamer(tokenizer, on_text),
+                      stopping_criteria=StoppingCriteriaList([_StopOnEvent(stop_event)]))
+    if stop_event.is_set():
+        return None
+    return json.loads(text)
+
+
+def partial_justification(text):
+    '''
+    Justification generated so far from a partial action choice JSON
+    response
+    '''
+    match = re.search(r'"detailed_reasoning"\s*:\s*"((?:[^"\\]|\\.)*)', text)
+    if match is None:
+        return ''
+    justification = match.group(1)
+    # Drop a trailing partial escape sequence before unescaping
+    justification = re.sub(r'\\(u[0-9a-fA-F]{0,3})?$', '', justification)
+    try:
+        return json.loads(f'"{justification}"')
+    except ValueError:
+        return justification
+
+
+def precompile_action_guide(instance, scenario_state, available_actions):
+    '''
+    Compile (or load) the structured-generation guide for a probe's action
+    choices ahead of running it
+    '''
+    if can_generate_directly(instance):
+        get_guide(instance.model.tokenizer,
+                  action_schema(format_choices(scenario_state, available_actions)),
+                  WHITESPACE_PATTERN)
+
+
+def response_to_action(available_actions, choices, response):
+    action = deepcopy(available_actions[choices.index(response['action_choice'])])
+    action.justification = response['detailed_reasoning']
+    return action
+
+
+def can_generate_directly(instance):
+    # ADMs running in worker processes (no local model) go through their
+    # own top_level_choose_action instead
+    return getattr(instance, 'model', None) is not None and supports_direct_generation(instance)
+
+
+def can_batch(runs):
+    model = getattr(runs[0].instance, 'model', None)
+    return all(
+        can_generate_directly(run.instance) and run.instance.model is model
+        for run in runs)
+
+
+def choose_actions_batched(runs, demo_kwargs):
+    '''
+    Choose an action for several GenerationRuns on one backbone, batching all
+    prompts through one generation call
+    '''
+    run_choices = [format_choices(run.scenario_state, run.available_actions) for run in runs]
+
+    responses = generate_json(runs[0].instance,
+                              [run.prompt for run in runs],
+                              [action_schema(choices) for choices in run_choices],
+                              demo_kwargs['max_generator_tokens'])
+    return [response_to_action(run.available_actions, choices, response)
+            for run, choices, response in zip(runs, run_choices, responses)]
+
+
+def choice_scores(run, choices):
+    '''
+    Log-likelihood of each choice as the response's action_choice, with no
+    reasoning generated first. One forward pass encodes the prompt and a
+    second scores every choice against its KV state.
+    '''
+    import torch
+
+    if len(choices) == 1:
+        return [0.0]
+
+    tokenizer = run.instance.model.tokenizer.tokenizer
+    model = run.instance.model.model
+    # Each choice is tokenized with the prompt so tokens merging across the
+    # boundary come out as they would in a generated response. Special
+    # tokens are added as the ADM's generator adds them to the prompt.
+    sequences = [tokenizer(run.prompt + CHOICE_ONLY_PREFIX + json.dumps(choice) + '}')['input_ids']
+                 for choice in choices]
+    shared = min(len(sequence) for sequence in sequences) - 1
+    for i in range(shared):
+        if any(sequence[i] != sequences[0][i] for sequence in sequences):
+            shared = i
+            break
+
+    continuations = [sequence[shared:] for sequence in sequences]
+    length = max(len(c) for c in continuations)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    continuation_ids = torch.tensor([c + [pad_token_id] * (length - len(c)) for c in continuations],
+                                    device=model.device)
+    continuation_mask = torch.tensor([[1] * len(c) + [0] * (length - len(c)) for c in continuations],
+                                     device=model.device)
+
+    with torch.no_grad(), span('model_forward'):
+        # Passed explicitly so the model returns a cache object rather than
+        # a legacy tuple, which can't be repeated per choice
+        prompt_output = model(input_ids=torch.tensor([sequences[0][:shared]], device=model.device),
+                              past_key_values=DynamicCache(), use_cache=True)
+        past_key_values = prompt_output.past_key_values
+        past_key_values.batch_repeat_interleave(len(choices))
+        attention_mask = torch.cat([
+            torch.ones(len(choices), shared, dtype=continuation_mask.dtype, device=model.device),
+            continuation_mask], dim=1)
+        logits = model(input_ids=continuation_ids, attention_mask=attention_mask,
+                       past_key_values=past_key_values).logits
+
+    # The first continuation token is predicted from the end of the prompt
+    first_logits = prompt_output.logits[:, -1:].expand(len(choices), 1, -1)
+    log_probs = torch.cat([first_logits, logits[:, :-1]], dim=1).float().log_softmax(-1)
+    token_log_probs = log_probs.gather(-1, continuation_ids.unsqueeze(-1)).squeeze(-1)
+    return (token_log_probs * continuation_mask).sum(-1).tolist()
+
+
+def choose_action_choice_only(run):
+    '''
+    The run's most likely action choice (see choice_scores), without a
+    justification. The choice may differ from a full run's, where the
+    reasoning is generated before the choice.
+    '''
+    choices = format_choices(run.scenario_state, run.available_actions)
+    scores = choice_scores(run, choices)
+    action = deepcopy(run.available_actions[scores.index(max(scores))])
+    action.justification = None
+    return action
+
+
+def choose_action_streaming(run, demo_kwargs, on_text, stop_event):
+    '''
+    Choose an action for a single GenerationRun, streaming the generated
+    text to on_text. Returns None if stopped early.
+    '''
+    choices = format_choices(run.scenario_state, run.available_actions)
+    response = stream_json(run.instance, run.prompt, action_schema(choices),
+                           demo_kwargs['max_generator_tokens'], on_text, stop_event)
+    if response is None:
+        return None
+    return response_to_action(run.available_actions, choices, response)
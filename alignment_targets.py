@@ -0,0 +1,71 @@
+import os
+
+from omegaconf import OmegaConf
+
+ALIGNMENT_TARGET_DIR = 'configs/hydra/alignment_target'
+# Slider values a sweep runs per attribute, matching the kdma-slider's
+# 0.1 steps
+SWEEP_STEPS = 11
+
+
+def load_alignment_target(name):
+    if name is None:
+        return None
+    return OmegaConf.load(os.path.join(ALIGNMENT_TARGET_DIR, f"{name}.yaml"))
+
+
+def alignment_target_name(kdma, value):
+    # There are only high and low target configs per attribute, so the
+    # slider value picks one of the two
+    return f"{kdma}_{'high' if float(value) >= 0.5 else 'low'}"
+
+
+def sweep_values(steps=SWEEP_STEPS):
+    return [round(i / (steps - 1), 2) for i in range(steps)]
+
+
+def sweep_targets(attributes, values):
+    '''
+    {target config name: [(kdma, value), ...]} over every attribute and
+    slider value. Values mapping to the same config share one entry, so
+    each config is generated once.
+    '''
+    targets = {}
+    for kdma in attributes:
+        for value in values:
+            targets.setdefault(alignment_target_name(kdma, value), []).append((kdma, value))
+    return targets
+
+
+def sweep_figure(attributes, values, action_labels, chosen):
+    '''
+    Heatmap figure of a sweep: one row per attribute, one column per slider
+    value, colored and labelled by the chosen action. chosen maps
+    (kdma, value) to an action label, or to an error message.
+    '''
+    labels = list(action_labels) + sorted(
+        {label for label in chosen.values() if label not in action_labels})
+    z = [[labels.index(chosen[(kdma, value)]) for value in values] for kdma in attributes]
+    text = [[chosen[(kdma, value)] for value in values] for kdma in attributes]
+    return {
+        'data': [{
+            'type': 'heatmap',
+            'x': [str(value) for value in values],
+            'y': list(attributes),
+            'z': z,
+            'text': text,
+            'texttemplate': '%{text}',
+            'hovertemplate': '%{y} = %{x}<br>%{text}<extra></extra>',
+            'zmin': 0,
+            'zmax': max(len(labels) - 1, 1),
+            'colorscale': 'Viridis',
+            'showscale': False,
+        }],
+        'layout': {
+            'template': 'plotly_dark',
+            'xaxis': {'title': 'KDMA value', 'type': 'category'},
+            'yaxis': {'type': 'category'},
+            'margin': {'l': 160, 'r': 20, 't': 20, 'b': 60},
+            'height': 120 + 80 * len(attributes),
+        },
+    }
@@ -1,46 +1,95 @@
-import json
-import os
+import copy
+import threading
 
 import dash
 import dash_bootstrap_components as dbc
 from dash import dcc, html
-from dash.dependencies import Input, Output, State
-import hydra
+from dash.dependencies import ALL, MATCH, Input, Output, State
 from omegaconf import OmegaConf
-import torch
 
-from align_system.utils.hydrate_state import hydrate_scenario_state
 # from transformers import pipeline
 
 
-from action_filtering import filter_actions
-from app_layout import model_1_layout, model_2_layout, load_dataset_components
+from alignment_targets import (
+    alignment_target_name,
+    load_alignment_target,
+    sweep_figure,
+    sweep_targets,
+    sweep_values,
+)
+from app_layout import (
+    MAX_PANELS,
+    MIN_PANELS,
+    attributes,
+    load_dataset_components,
+    model_panel_layout,
+    panel_id,
+)
+from dataset_registry import (
+    get_dataset,
+    get_scenario_ids,
+    get_scenario_probe,
+    get_scenario_probes,
+    load_dataset,
+)
+from metrics import Trace, get_panel_trace, register_metrics, set_panel_trace, span, use_traces
+from model_loader import get_load_status, get_panel_adm, submit_load
+from precomputed_results import PRECOMPUTED_RESULTS, ResultKey, target_id
+from prompt_model import (
+    SYSTEM_PROMPT_ID,
+    PromptEditError,
+    apply_changes,
+    get_panel_prompt,
+    store_panel_prompt,
+    structure_prompt,
+)
+from request_queue import Job, QueueFull, get_model_queue
+from response_format import format_response
+from response_stream import get_stream, start_stream, stop_stream
+from result_cache import RESULT_CACHE, result_key
+from session_registry import new_session_id, panel_key
 
-# Initialize an algorithm with an empty config as a placeholder
-adm = None
-adm_2 = None
-# Torch determinism for reproducibility
-os.environ["CUBLAS_WORKSPACE_CONFIG"] = ":4096:8"
-torch.use_deterministic_algorithms(True)
+# adm_generation (torch, transformers, outlines) is imported inside the
+# callbacks that generate, which only run once a model has been loaded, so
+# the layout serves without waiting on those imports
 
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.SLATE, dbc.icons.BOOTSTRAP])
+# Stage timings and token counts are served in Prometheus format at /metrics
+register_metrics(app.server)
+
+def serve_layout():
+    # Served per page load so every browser session gets its own ID, and
+    # with it its own set of panels on the server
+    return dbc.Container(fluid=True, style={'width': '100%'}, children=[
+        html.H1('Align-Demo', className='mb-4'),
+
+        # Store component to keep track of attribute values
+        dcc.Store(id='session-id', data=new_session_id()),
+        dcc.Store(id='dataset-store'),
+        dcc.Store(id='scenario-id-store'),
+
+        dbc.Stack(children=load_dataset_components(), direction='horizontal', gap=3),
+        html.Hr(),
+        dbc.Row([
+            dbc.Col(children=model_panel_layout(index), id=panel_id('panel-col', index),
+                    style={} if index < MIN_PANELS else {'display': 'none'})
+            for index in range(MAX_PANELS)
+        ])
+    ])
 
-app.layout = dbc.Container(fluid=True, style={'width': '100%'}, children=[
-    html.H1('Align-Demo', className='mb-4'),
+app.layout = serve_layout
 
-    # Store component to keep track of attribute values
-    dcc.Store(id='dataset-store'),
-    dcc.Store(id='scenario-id-store'),
-    dcc.Store(id='alignment-target-store'),
-    dcc.Store(id='alignment-target-store-2'),
 
-    dbc.Stack(children=load_dataset_components, direction='horizontal', gap=3),
-    html.Hr(),
-    dbc.Row([
-        dbc.Col(children=model_1_layout),
-        dbc.Col(children=model_2_layout),
-    ])
-])
+@app.callback(
+    [Output(panel_id('panel-col', ALL), 'width'),
+     Output(panel_id('panel-col', ALL), 'style')],
+    Input('num-panels-dropdown', 'value'),
+)
+def show_panels(num_panels):
+    # Up to three panels per row; hidden panels keep their loaded models
+    width = 12 // min(num_panels, 3)
+    return ([width] * MAX_PANELS,
+            [{} if index < num_panels else {'display': 'none'} for index in range(MAX_PANELS)])
 
 
 ### -------------------- Load Dataset to Store -------------------------- ###
@@ -51,21 +100,9 @@ app.layout = dbc.Container(fluid=True, style={'width': '100%'}, children=[
     prevent_initial_call=True,
 )
 def load_dataset_store(selected_dataset):
-    with open(f'oracle-json-files/{selected_dataset}', 'r') as f:
-        dataset = json.load(f)
-        scenario_ids = []
-        scenarios = {}
-        for record in dataset:
-            scenario_id = record['input']['scenario_id']
-
-            if scenario_id not in scenarios:
-                scenario_ids.append(scenario_id)
-                scenarios[scenario_id] = []
-
-            scenarios[scenario_id].append(
-                record['input']
-            )
-        return scenarios, scenario_ids
+    with span('dataset_load'):
+        handle = load_dataset(selected_dataset)
+        return handle, get_scenario_ids(handle)
 
 ### -------------------- Updated Scenario ID Dropdowns for both models --------------------- ###
 @app.callback(
@@ -88,361 +125,579 @@ def update_scenario_id_dropdown(scenario_ids):
     Input('scenario-id-dropdown', 'value'),
     prevent_initial_call=True,
 )
-def update_probe_id_dropdown(scenarios, scenario_id):
-    if scenarios:
-        probe_ids = []
-        for scenario in scenarios[scenario_id]:
-            state, actions = hydrate_scenario_state(scenario)
-            state_dict = state.to_dict()
-            if state.elapsed_time != 0:
-                probe_id = state_dict["meta_info"]["probe_response"]["probe_id"]
-            else:
-                probe_id = 'N/A'
-            probe_ids.append(probe_id)
-        return [{'label': p_id, 'value': p_id} for p_id in probe_ids]
+def update_probe_id_dropdown(dataset, scenario_id):
+    if dataset:
+        # Read from the dataset catalog; probes are only hydrated once chosen
+        probes = get_scenario_probes(dataset, scenario_id)
+        return [{'label': f"{p['probe_id']} ({p['characters']} characters, {p['actions']} actions)",
+                 'value': p['probe_id']}
+                for p in probes]
     else:
         return []
 
 ### -------------------- LLM loading and ADM instantiation -------------------------- ###
+def _load_status_text(status):
+    if status is None:
+        return ''
+    return '\n'.join(status['progress'])
+
+
 @app.callback(
-    Output('load-model-button', 'disabled'),
-    [Input('load-model-button', 'n_clicks')],
-    [State('llm-dropdown', 'value'),
-     State('adm-config-input', 'value'),
-     State('system-prompt-checklist', 'value')],
+    [Output(panel_id('load-model-button', MATCH), 'disabled'),
+     Output(panel_id('model-load-interval', MATCH), 'disabled')],
+    [Input(panel_id('load-model-button', MATCH), 'n_clicks')],
+    [State(panel_id('llm-dropdown', MATCH), 'value'),
+     State(panel_id('adm-config-input', MATCH), 'value'),
+     State(panel_id('system-prompt-checklist', MATCH), 'value'),
+     State(panel_id('precision-dropdown', MATCH), 'value'),
+     State(panel_id('device-dropdown', MATCH), 'value'),
+     State('session-id', 'data')],
     prevent_initial_call=True
 )
-def load_llm(n_clicks, llm_backbone, adm_type, aligned):
+def load_llm(n_clicks, llm_backbone, adm_type, aligned, precision, device, session_id):
     if n_clicks > 0:
-        adm_config_path = os.path.join('configs/hydra/adm', f"{adm_type}_baseline.yaml")
-        if aligned is not None:
-            adm_config_path = os.path.join('configs/hydra/adm', f"{adm_type}_aligned.yaml")
-        adm_config = OmegaConf.load(adm_config_path)
-        adm_config["model_name"] = llm_backbone
-        global adm
-        adm = hydra.utils.instantiate(adm_config, recursive=True)
-        return False
+        # Loading happens in the background; duplicate clicks while a load
+        # is queued or running are ignored
+        panel = panel_key(session_id, dash.ctx.triggered_id['index'])
+        submit_load(panel, llm_backbone, adm_type, aligned and 'aligned' in aligned, precision, device)
+        return True, False
 
 @app.callback(
-    Output('load-model-button-2', 'disabled'),
-    [Input('load-model-button-2', 'n_clicks')],
-    [State('llm-dropdown-2', 'value'),
-     State('adm-config-input-2', 'value'),
-     State('system-prompt-checklist-2', 'value')],
+    [Output(panel_id('model-load-status', MATCH), 'children'),
+     Output(panel_id('load-model-button', MATCH), 'disabled', allow_duplicate=True),
+     Output(panel_id('model-load-interval', MATCH), 'disabled', allow_duplicate=True)],
+    Input(panel_id('model-load-interval', MATCH), 'n_intervals'),
+    State('session-id', 'data'),
     prevent_initial_call=True
 )
-def load_llm_2(n_clicks, llm_backbone, adm_type, aligned):
-    if n_clicks > 0:
-        adm_config_path = os.path.join('configs/hydra/adm', f"{adm_type}_baseline.yaml")
-        if aligned is not None:
-            adm_config_path = os.path.join('configs/hydra/adm', f"{adm_type}_aligned.yaml")
-        adm_config = OmegaConf.load(adm_config_path)
-        adm_config["model_name"] = llm_backbone
-        global adm_2
-        adm_2 = hydra.utils.instantiate(adm_config, recursive=True)
-        return False
+def update_load_status(n_intervals, session_id):
+    status = get_load_status(panel_key(session_id, dash.ctx.triggered_id['index']))
+    loading = status is not None and status['status'] in ('queued', 'loading')
+    return _load_status_text(status), loading, not loading
 
 ### -------------------- Load Alignment Target -------------------------- ###
 @app.callback(
-    [Output('alignment-target-store', 'data')],
-    Input('load-system-prompt-button', 'n_clicks'),
-    [State('system-prompt-checklist', 'value'),
-     State('kdma-dropdown', 'value'),
-     State('kdma-slider', 'value')],
-    prevent_initial_call=True,
-)
-def load_alignment_target(n_clicks, is_aligned, kdma, kdma_value):
-    if n_clicks > 0:
-        if kdma and 'aligned' in is_aligned:
-            kdma_split = kdma.split('_')
-            kdma_file = ' '.join(kdma_split).capitalize()
-            if kdma_file in ["Moral deservingness", "Maximization"]:
-                binary_alignment = "low"
-                print(kdma_value)
-                if float(kdma_value) >= 0.5:
-                    binary_alignment = "high"
-                alignment_target = OmegaConf.load(os.path.join("configs/hydra/alignment_target",f"{kdma}_{binary_alignment}.yaml"))
-
-            alignment_target = OmegaConf.to_object(alignment_target)
-        else:
-            alignment_target = None
-        return [alignment_target]
-
-@app.callback(
-    [Output('alignment-target-store-2', 'data')],
-    Input('load-system-prompt-button-2', 'n_clicks'),
-    [State('system-prompt-checklist-2', 'value'),
-     State('kdma-dropdown-2', 'value'),
-     State('kdma-slider-2', 'value')],
+    [Output(panel_id('alignment-target-store', MATCH), 'data')],
+    Input(panel_id('load-system-prompt-button', MATCH), 'n_clicks'),
+    [State(panel_id('system-prompt-checklist', MATCH), 'value'),
+     State(panel_id('kdma-dropdown', MATCH), 'value'),
+     State(panel_id('kdma-slider', MATCH), 'value')],
     prevent_initial_call=True,
 )
-def load_alignment_target_2(n_clicks, is_aligned, kdma, kdma_value):
+def update_alignment_target_store(n_clicks, is_aligned, kdma, kdma_value):
     if n_clicks > 0:
-        if kdma and 'aligned' in is_aligned:
-            kdma_split = kdma.split('_')
-            kdma_file = ' '.join(kdma_split).capitalize()
-            if kdma_file in ["Moral deservingness", "Maximization"]:
-                binary_alignment = "low"
-                if float(kdma_value) >= 0.5:
-                    binary_alignment = "high"
-                alignment_target = OmegaConf.load(os.path.join("configs/hydra/alignment_target",f"{kdma}_{binary_alignment}.yaml"))
-
+        if kdma and is_aligned and 'aligned' in is_aligned:
+            alignment_target = load_alignment_target(alignment_target_name(kdma, kdma_value))
             alignment_target = OmegaConf.to_object(alignment_target)
         else:
             alignment_target = None
         return [alignment_target]
 
 @app.callback(
-    [Output('slider-div', 'style'),
-     Output('alignment-target-stack', 'style'),
-     Output('space-div', 'style')],
-    Input('system-prompt-checklist', 'value'),
+    [Output(panel_id('slider-div', MATCH), 'style'),
+     Output(panel_id('alignment-target-stack', MATCH), 'style'),
+     Output(panel_id('space-div', MATCH), 'style')],
+    Input(panel_id('system-prompt-checklist', MATCH), 'value'),
     prevent_initial_call=True
 )
 def show_hide_alignment_target(aligned):
-    if 'aligned' in aligned and aligned is not None:
-        return {'display': 'block'}, {'display': 'flex'}, {'display': 'none'}
-    return {'display': 'none'}, {'display': 'none'}, {'display': 'block', 'marginBottom': '170px'}
-
-@app.callback(
-    [Output('slider-div-2', 'style'),
-     Output('alignment-target-stack-2', 'style'),
-     Output('space-div-2', 'style')],
-    Input('system-prompt-checklist-2', 'value'),
-    prevent_initial_call=True
-)
-def show_hide_alignment_target_2(aligned):
-    if 'aligned' in aligned and aligned is not None:
+    if aligned is not None and 'aligned' in aligned:
         return {'display': 'block'}, {'display': 'flex'}, {'display': 'none'}
     return {'display': 'none'}, {'display': 'none'}, {'display': 'block', 'marginBottom': '170px'}
 
 ### ------------------------ Load ADM System Prompt to UI ------------------------ ###
 
 @app.callback(
-    [Output('system-prompt', 'value'),
-     Output('action-choices-prompt', 'value')],
-    [Input('load-system-prompt-button', 'n_clicks'),
-     Input('alignment-target-store', 'data')],
-    [State('dataset-store', 'data'),
+    [Output(panel_id('system-prompt', MATCH), 'value'),
+     Output(panel_id('action-choices-prompt', MATCH), 'value')],
+    [Input(panel_id('load-system-prompt-button', MATCH), 'n_clicks'),
+     Input(panel_id('alignment-target-store', MATCH), 'data')],
+    [State('session-id', 'data'),
+     State('dataset-store', 'data'),
      State('scenario-id-dropdown', 'value'),
      State('probe-id-dropdown', 'value')],
     prevent_initial_call=True
 )
-def load_system_prompt(n_clicks, alignment_target, scenarios, scenario_id, probe_id):
+def load_system_prompt(n_clicks, alignment_target, session_id, dataset, scenario_id, probe_id):
     if n_clicks > 0:
-        for scenario in scenarios[scenario_id]:
-            state, actions = hydrate_scenario_state(scenario)
-            actions_filtered = filter_actions(state, actions)
-            state_dict = state.to_dict()
-            if state_dict["meta_info"]["probe_response"] is not None:
-                if probe_id != state_dict["meta_info"]["probe_response"]["probe_id"]:
-                    continue
-                probe_id = state_dict["meta_info"]["probe_response"]["probe_id"]
-        kwargs = {
-            'demo_kwargs': {
-                'max_generator_tokens': 8092,
-                'generator_seed': 2,
-                'shuffle_choices': False
-            }
-        }
+        from adm_generation import KDMA_DESCRIPTIONS_MAP
+
+        panel = panel_key(session_id, dash.ctx.triggered_id['index'])
+        trace = Trace()
+        set_panel_trace(panel, trace)
+
+        with span('hydration', trace):
+            probe = get_scenario_probe(dataset, scenario_id, probe_id)
+        state, actions_filtered = probe.state, probe.actions_filtered
         if alignment_target is not None:
             alignment_target = OmegaConf.create(alignment_target)
 
-        prompts, _ = adm.instance.get_dialog_texts(
-            scenario_state=state,
-            available_actions=actions_filtered,
-            alignment_target=alignment_target,
-            kdma_descriptions_map="configs/prompt_engineering/kdma_descriptions.yml",
-            demo_kwargs=kwargs["demo_kwargs"]
-        )
+        adm = get_panel_adm(panel)
+        # The loaded prompt is the ADM's default, not one left on the
+        # instance by an earlier edited RUN MODEL, so an unedited prompt
+        # matches what the precomputed results were generated from
+        instance = copy.copy(adm.instance)
+        instance.system_ui_prompt = None
+        with span('prompt_build', trace):
+            prompts, _ = instance.get_dialog_texts(
+                scenario_state=state,
+                available_actions=actions_filtered,
+                alignment_target=alignment_target,
+                kdma_descriptions_map=KDMA_DESCRIPTIONS_MAP,
+                demo_kwargs=DEMO_KWARGS
+            )
+            # The structured prompt stays on the server so RUN MODEL can map
+            # edits back to state fields
+            structured = structure_prompt(prompts[0], state)
+        store_panel_prompt(panel, _probe_key(dataset, scenario_id, probe_id), structured)
+
+        # Compile the action choice guide now so RUN MODEL doesn't wait on it
+        threading.Thread(target=_precompile_action_guide,
+                         args=(trace, adm.instance, state, actions_filtered), daemon=True).start()
+
+        return [structured.render()], [structured.action_choices]
+
+def _precompile_action_guide(trace, instance, state, actions_filtered):
+    from adm_generation import precompile_action_guide
+
+    with use_traces(trace):
+        precompile_action_guide(instance, state, actions_filtered)
+
+### ------------------------ Run ADM inference to generate response ------------------------ ###
+DEMO_KWARGS = {
+    'max_generator_tokens': 8092,
+    'generator_seed': 2,
+    'shuffle_choices': False
+}
+# Choice-only runs are cached apart from full runs of the same inputs
+CHOICE_ONLY_DEMO_KWARGS = dict(DEMO_KWARGS, choice_only=True)
+
+
+def _probe_key(dataset, scenario_id, probe_id):
+    return (dataset['dataset'], dataset['version'], scenario_id, probe_id)
+
+
+def _cache_response(key, action_taken, response):
+    RESULT_CACHE.put(key, action_taken.action_id, action_taken.justification, response)
+    return response
+
+
+def _precomputed_response(adm, dataset, scenario_id, probe_id, alignment_target, probe):
+    # Response of an unedited prompt from the precomputed results store, if
+    # the panel's ADM inputs were precomputed for this version of the dataset
+    load_inputs = getattr(adm, 'load_inputs', None)
+    if load_inputs is None:
+        return None
+    key = ResultKey(dataset['dataset'], scenario_id, probe_id,
+                    alignment_target=target_id(alignment_target), **load_inputs)
+    result = PRECOMPUTED_RESULTS.get(key, get_dataset(dataset).catalog['sha256'])
+    if result is None:
+        return None
+
+    action_taken = next((a for a in probe.actions_filtered if a.action_id == result['action_id']), None)
+    if action_taken is None:
+        return None
+    action_taken = copy.copy(action_taken)
+    action_taken.justification = result['justification']
+    return format_response(probe.actions_filtered, action_taken)
+
+
+def _generation_run(adm, probe, state, alignment_target):
+    from adm_generation import KDMA_DESCRIPTIONS_MAP, GenerationRun
+
+    dialog_texts, _ = adm.instance.get_dialog_texts(
+        scenario_state=state,
+        available_actions=probe.actions_filtered,
+        alignment_target=alignment_target,
+        kdma_descriptions_map=KDMA_DESCRIPTIONS_MAP,
+        demo_kwargs=DEMO_KWARGS
+    )
+    return GenerationRun(adm.instance, dialog_texts[0], state, probe.actions_filtered)
+
+
+def _run_batch(runs):
+    from adm_generation import can_generate_directly, choose_actions_batched
+
+    # The fake ADM has no model to generate with and batches on its own
+    if not can_generate_directly(runs[0].instance):
+        return runs[0].instance.choose_actions_batched(runs)
+    return choose_actions_batched(runs, DEMO_KWARGS)
+
+
+def _panel_queue(adm):
+    # Panels and sessions sharing a backbone share its queue
+    return get_model_queue(getattr(adm.instance, 'model', adm.instance), run_batch=_run_batch)
+
+
+def _prepare_panel_run(panel, alignment_target, dataset, system_prompt, scenario_id, probe_id,
+                       choice_only=False):
+    '''
+    Returns (response, job) for a panel run. response is set when nothing
+    needs generating: a cached response, or why the prompt can't be run.
+    Otherwise job is a request_queue.Job that produces and caches the
+    response, streaming generated text where the ADM supports it.
+    choice_only runs only score the action choices, where the ADM supports
+    it, leaving the justification to a later full run.
+    '''
+    from adm_generation import (
+        KDMA_DESCRIPTIONS_MAP,
+        can_generate_directly,
+        choose_action_choice_only,
+        choose_action_streaming,
+    )
+
+    trace = Trace()
+    set_panel_trace(panel, trace)
+
+    with span('hydration', trace):
+        probe = get_scenario_probe(dataset, scenario_id, probe_id)
+    adm = get_panel_adm(panel)
+
+    # Generation is deterministic, so identical inputs replay the cached
+    # response instead of regenerating it
+    choice_only = choice_only and can_generate_directly(adm.instance)
+    with span('cache_lookup', trace):
+        key = result_key(adm.config, alignment_target, system_prompt, probe.actions_filtered,
+                         CHOICE_ONLY_DEMO_KWARGS if choice_only else DEMO_KWARGS)
+        cached = RESULT_CACHE.get(key)
+    if cached is not None:
+        return cached['response'], None
+
+    # Only the sections edited since LOAD SYSTEM PROMPT are applied, on top
+    # of the indexed probe state
+    structured = get_panel_prompt(panel, _probe_key(dataset, scenario_id, probe_id))
+    if structured is None:
+        return "Load the system prompt for this probe before running the model.", None
+    if isinstance(system_prompt, list):
+        system_prompt = system_prompt[0]
+    with span('prompt_build', trace):
+        try:
+            values = structured.parse(system_prompt)
+        except PromptEditError as e:
+            return f"PROMPT EDIT NOT SUPPORTED:\n{e}", None
+        changes = structured.changes(values)
+        state = apply_changes(probe.state, changes)
+    top_level_system_prompt = values.get(SYSTEM_PROMPT_ID)
+
+    # Unedited prompts are answered from the precomputed results when the
+    # store has them; edits always generate live
+    if not changes:
+        with span('precomputed_lookup', trace):
+            response = _precomputed_response(adm, dataset, scenario_id, probe_id, alignment_target, probe)
+        if response is not None:
+            return response, None
+
+    if alignment_target is not None:
+        alignment_target = OmegaConf.create(alignment_target)
+
+    adm.instance.system_ui_prompt = top_level_system_prompt
+
+    def finish(action_taken):
+        return _cache_response(key, action_taken, format_response(probe.actions_filtered, action_taken))
+
+    if choice_only:
+        with span('prompt_build', trace):
+            choice_run = _generation_run(adm, probe, state, alignment_target)
+        run = None
+
+        def generate(on_text, stop_event):
+            return finish(choose_action_choice_only(choice_run))
+    elif can_generate_directly(adm.instance):
+        with span('prompt_build', trace):
+            run = _generation_run(adm, probe, state, alignment_target)
+
+        def generate(on_text, stop_event):
+            action_taken = choose_action_streaming(run, DEMO_KWARGS, on_text, stop_event)
+            if action_taken is None:
+                return None
+            return finish(action_taken)
+    elif hasattr(adm.instance, 'choose_actions_batched'):
+        # The fake ADM (ALIGN_DEMO_FAKE_ADM) doesn't stream, but its runs
+        # are batchable so load tests exercise micro-batching without weights
+        with span('prompt_build', trace):
+            run = _generation_run(adm, probe, state, alignment_target)
+
+        def generate(on_text, stop_event):
+            action_taken, = adm.instance.choose_actions_batched([run])
+            return finish(action_taken)
+    else:
+        run = None
+
+        def generate(on_text, stop_event):
+            action_taken, _ = adm.instance.top_level_choose_action(
+                scenario_state=state,
+                available_actions=probe.actions_filtered,
+                alignment_target=alignment_target,
+                kdma_descriptions_map=KDMA_DESCRIPTIONS_MAP,
+                tokenizer_kwargs={'truncation': False},
+                demo_kwargs=DEMO_KWARGS)
+            return finish(action_taken)
+
+    return None, Job(generate, run=run, finish=finish, trace=trace)
+
+
+def _stream_response_text(stream):
+    from adm_generation import partial_justification
+
+    if stream.response is not None:
+        return stream.response
+
+    if stream.status == 'queued':
+        return f"Queued (position {stream.position()})"
+
+    text = f"JUSTIFICATION:\n{partial_justification(stream.text)}"
+    if stream.status == 'stopped':
+        text += "\n\n[STOPPED]"
+    return text
 
-        prompt_sections = prompts[0].split('\n\n')
 
-        prompt = '\n\n'.join(prompt_sections[:-1])
-        action_choices = prompt_sections[-1]
+def _run_in_progress(panel):
+    stream = get_stream(panel)
+    return stream is not None and stream.status in ('queued', 'running')
+
+
+def _run_in_progress_text(panel):
+    # The earlier run keeps streaming into the panel, replacing this notice
+    # on the next poll
+    return ("A run is already in progress for this panel, wait for it or press STOP.\n\n"
+            f"{_stream_response_text(get_stream(panel))}")
 
-        return [prompt], [action_choices]
 
 @app.callback(
-    [Output('system-prompt-2', 'value'),
-     Output('action-choices-prompt-2', 'value')],
-    [Input('load-system-prompt-button-2', 'n_clicks'),
-     Input('alignment-target-store-2', 'data')],
-    [State('dataset-store', 'data'),
+    [Output(panel_id('system-response', MATCH), 'value'),
+     Output(panel_id('response-stream-interval', MATCH), 'disabled')],
+    [Input(panel_id('run-button', MATCH), 'n_clicks'),
+     Input(panel_id('justify-button', MATCH), 'n_clicks')],
+    [State(panel_id('alignment-target-store', MATCH), 'data'),
+     State(panel_id('system-prompt', MATCH),'value'),
+     State(panel_id('choice-only-checklist', MATCH), 'value'),
+     State('session-id', 'data'),
+     State('dataset-store', 'data'),
      State('scenario-id-dropdown', 'value'),
      State('probe-id-dropdown', 'value')],
     prevent_initial_call=True
 )
-def load_system_prompt_2(n_clicks, alignment_target, scenarios, scenario_id, probe_id):
-    if n_clicks > 0:
-        for scenario in scenarios[scenario_id]:
-            state, actions = hydrate_scenario_state(scenario)
-            actions_filtered = filter_actions(state, actions)
-            state_dict = state.to_dict()
-            if state_dict["meta_info"]["probe_response"] is not None:
-                if probe_id != state_dict["meta_info"]["probe_response"]["probe_id"]:
-                    continue
-                probe_id = state_dict["meta_info"]["probe_response"]["probe_id"]
-
-        kwargs = {
-            'demo_kwargs': {
-                'max_generator_tokens': 8092,
-                'generator_seed': 2,
-                'shuffle_choices': False
-            }
-        }
-        if alignment_target is not None:
-            alignment_target = OmegaConf.create(alignment_target)
-        prompts, positive_dialogs = adm_2.instance.get_dialog_texts(
-            scenario_state=state,
-            available_actions=actions_filtered,
-            alignment_target=alignment_target,
-            kdma_descriptions_map="configs/prompt_engineering/kdma_descriptions.yml",
-            demo_kwargs=kwargs["demo_kwargs"]
-        )
-
-        prompt_sections = prompts[0].split('\n\n')
+def run_model(n_clicks, justify_clicks, alignment_target, system_prompt, choice_only, session_id,
+              dataset, scenario_id, probe_id):
+    if (n_clicks or 0) > 0 or (justify_clicks or 0) > 0:
+        # JUSTIFY is a full run, which generates the justification a
+        # choice-only run left out
+        choice_only = (dash.ctx.triggered_id['type'] == 'run-button' and
+                       bool(choice_only) and 'choice_only' in choice_only)
+        panel = panel_key(session_id, dash.ctx.triggered_id['index'])
+        if _run_in_progress(panel):
+            return _run_in_progress_text(panel), dash.no_update
+        response, job = _prepare_panel_run(
+            panel, alignment_target, dataset, system_prompt, scenario_id, probe_id, choice_only)
+        if job is None:
+            return response, True
+        # The response is streamed into the panel by update_response_stream
+        try:
+            started = start_stream(panel, _panel_queue(get_panel_adm(panel)), job)
+        except QueueFull as e:
+            return f"SERVER BUSY: {e}, try again shortly.", True
+        if not started:
+            return _run_in_progress_text(panel), dash.no_update
+        return _stream_response_text(job), False
 
-        prompt = '\n\n'.join(prompt_sections[:-1])
-        action_choices = prompt_sections[-1]
+@app.callback(
+    [Output(panel_id('system-response', MATCH), 'value', allow_duplicate=True),
+     Output(panel_id('response-stream-interval', MATCH), 'disabled', allow_duplicate=True),
+     Output(panel_id('stop-button', MATCH), 'disabled')],
+    Input(panel_id('response-stream-interval', MATCH), 'n_intervals'),
+    State('session-id', 'data'),
+    prevent_initial_call=True
+)
+def update_response_stream(n_intervals, session_id):
+    stream = get_stream(panel_key(session_id, dash.ctx.triggered_id['index']))
+    if stream is None:
+        return dash.no_update, True, True
+    running = stream.status in ('queued', 'running')
+    return _stream_response_text(stream), not running, not running
 
-        return [prompt], [action_choices]
+@app.callback(
+    Output(panel_id('stop-button', MATCH), 'disabled', allow_duplicate=True),
+    Input(panel_id('stop-button', MATCH), 'n_clicks'),
+    State('session-id', 'data'),
+    prevent_initial_call=True
+)
+def stop_model(n_clicks, session_id):
+    # Stops generation at the next token, freeing the GPU, or drops the
+    # request if it is still queued
+    stop_stream(panel_key(session_id, dash.ctx.triggered_id['index']))
+    return True
 
-### ------------------------ Run ADM inference to generate response ------------------------ ###
 @app.callback(
-    [Output('system-response', 'value')],
-    [Input('run-button', 'n_clicks')],
-    [State('alignment-target-store', 'data'),
+    Output(panel_id('system-response', ALL), 'value', allow_duplicate=True),
+    [Input('run-all-button', 'n_clicks')],
+    [State(panel_id('alignment-target-store', ALL), 'data'),
+     State(panel_id('system-prompt', ALL),'value'),
+     State(panel_id('choice-only-checklist', ALL), 'value'),
+     State('num-panels-dropdown', 'value'),
+     State('session-id', 'data'),
      State('dataset-store', 'data'),
-     State('system-prompt','value'),
      State('scenario-id-dropdown', 'value'),
      State('probe-id-dropdown', 'value')],
     prevent_initial_call=True
 )
-def run_model(n_clicks, alignment_target, scenarios, system_prompt, scenario_id, probe_id):
-
+def run_all_models(n_clicks, alignment_targets, system_prompts, choice_only, num_panels, session_id,
+                   dataset, scenario_id, probe_id):
     if n_clicks > 0:
-        for scenario in scenarios[scenario_id]:
-            state, actions = hydrate_scenario_state(scenario)
-            actions_filtered = filter_actions(state, actions)
-            state_dict = state.to_dict()
-            if state_dict["meta_info"]["probe_response"] is not None:
-                if probe_id != state_dict["meta_info"]["probe_response"]["probe_id"]:
-                    continue
-                probe_id = state_dict["meta_info"]["probe_response"]["probe_id"]
-        if alignment_target is not None:
-            alignment_target = OmegaConf.create(alignment_target)
-
-        if isinstance(system_prompt, list):
-            system_prompt = system_prompt[0]
+        responses = [dash.no_update] * len(system_prompts)
+
+        # Each model's panels are queued together so the queue batches
+        # panels sharing a backbone into one generation call
+        queued = {}
+        for index, (target, prompt, panel_choice_only) in enumerate(
+                zip(alignment_targets, system_prompts, choice_only)):
+            panel = panel_key(session_id, index)
+            adm = get_panel_adm(panel)
+            if index >= num_panels or adm is None or not prompt:
+                continue
+
+            response, job = _prepare_panel_run(
+                panel, target, dataset, prompt, scenario_id, probe_id,
+                bool(panel_choice_only) and 'choice_only' in panel_choice_only)
+            if job is None:
+                responses[index] = response
+            else:
+                queue, jobs = queued.setdefault(id(_panel_queue(adm)), (_panel_queue(adm), {}))
+                jobs[index] = job
+
+        for queue, jobs in queued.values():
+            try:
+                queue.submit_many(list(jobs.values()))
+            except QueueFull as e:
+                for index in jobs:
+                    responses[index] = f"SERVER BUSY: {e}, try again shortly."
+                continue
+            for index, job in jobs.items():
+                responses[index] = job.wait()
+
+        return responses
+
+### ------------------------ Alignment target sweep ------------------------ ###
+def _sweep_job(instance, probe, state, alignment_target, choice_only, trace):
+    from adm_generation import (
+        KDMA_DESCRIPTIONS_MAP,
+        GenerationRun,
+        can_generate_directly,
+        choose_action_choice_only,
+        choose_action_streaming,
+    )
+
+    if not can_generate_directly(instance):
+        def generate(on_text, stop_event):
+            action_taken, _ = instance.top_level_choose_action(
+                scenario_state=state,
+                available_actions=probe.actions_filtered,
+                alignment_target=alignment_target,
+                kdma_descriptions_map=KDMA_DESCRIPTIONS_MAP,
+                tokenizer_kwargs={'truncation': False},
+                demo_kwargs=DEMO_KWARGS)
+            return action_taken
+        return Job(generate, trace=trace)
+
+    dialog_texts, _ = instance.get_dialog_texts(
+        scenario_state=state,
+        available_actions=probe.actions_filtered,
+        alignment_target=alignment_target,
+        kdma_descriptions_map=KDMA_DESCRIPTIONS_MAP,
+        demo_kwargs=DEMO_KWARGS
+    )
+    run = GenerationRun(instance, dialog_texts[0], state, probe.actions_filtered)
+    if choice_only:
+        return Job(lambda on_text, stop_event: choose_action_choice_only(run), trace=trace)
+    # Full runs are batchable, so the queue generates every target of the
+    # sweep in one call
+    return Job(lambda on_text, stop_event: choose_action_streaming(run, DEMO_KWARGS, on_text, stop_event),
+               run=run, finish=lambda action_taken: action_taken, trace=trace)
 
-        top_level_system_prompt = system_prompt.split('\n\n')[0].split('[INST]')[1]
-        state.unstructured = system_prompt.split('\n\n')[2].split('\n')[1]
-        character_unstructured = system_prompt.split('\n\n')[1].split('\n')[1:]
-        print(character_unstructured)
-        for i, j in zip(range(len(state.characters)), range(0, len(state.characters) * 2, 2)):
-            state.characters[i].unstructured = character_unstructured[j].split(':')[1]
-            state.characters[i].intent = character_unstructured[j+1].split(':')[1]
-
-        adm.instance.system_ui_prompt = top_level_system_prompt
-
-        kwargs = {
-            'demo_kwargs': {
-                'max_generator_tokens': 8092,
-                'generator_seed': 2,
-                'shuffle_choices': False
-            }
-        }
-        action_taken, _ = adm.instance.top_level_choose_action(
-            scenario_state=state,
-            available_actions=actions_filtered,
-            alignment_target=alignment_target,
-            kdma_descriptions_map='configs/prompt_engineering/kdma_descriptions.yml',
-            tokenizer_kwargs={'truncation': False},
-            demo_kwargs=kwargs["demo_kwargs"])
-
-        actions_filtered_dicts = [action.to_dict() for action in actions_filtered]
-        action_taken_dict = action_taken.to_dict()
-        for action_gt in actions_filtered_dicts:
-            if action_gt['action_id'] == action_taken_dict['action_id']:
-                chosen_action_gt = action_gt
-                break
-
-        chosen_action_gt = chosen_action_gt["unstructured"]
-        return [
-            f"ACTION CHOICE:\n"
-            f"{chosen_action_gt}"
-            f"\n\nJUSTIFICATION:\n"
-            f"{action_taken.justification}"
-        ]
 
 @app.callback(
-    [Output('system-response-2', 'value')],
-    [Input('run-button-2', 'n_clicks')],
-    [State('alignment-target-store-2', 'data'),
+    [Output(panel_id('sweep-graph', MATCH), 'figure'),
+     Output(panel_id('sweep-graph', MATCH), 'style'),
+     Output(panel_id('system-response', MATCH), 'value', allow_duplicate=True)],
+    Input(panel_id('sweep-button', MATCH), 'n_clicks'),
+    [State(panel_id('system-prompt', MATCH), 'value'),
+     State(panel_id('choice-only-checklist', MATCH), 'value'),
+     State('session-id', 'data'),
      State('dataset-store', 'data'),
-     State('system-prompt-2','value'),
      State('scenario-id-dropdown', 'value'),
      State('probe-id-dropdown', 'value')],
     prevent_initial_call=True
 )
-def run_model_2(n_clicks, alignment_target, scenarios, system_prompt, scenario_id, probe_id):
-
+def run_sweep(n_clicks, system_prompt, choice_only, session_id, dataset, scenario_id, probe_id):
     if n_clicks > 0:
-        for scenario in scenarios[scenario_id]:
-            state, actions = hydrate_scenario_state(scenario)
-            actions_filtered = filter_actions(state, actions)
-            state_dict = state.to_dict()
-            if state_dict["meta_info"]["probe_response"] is not None:
-                if probe_id != state_dict["meta_info"]["probe_response"]["probe_id"]:
-                    continue
-                probe_id = state_dict["meta_info"]["probe_response"]["probe_id"]
-        if alignment_target is not None:
-            alignment_target = OmegaConf.create(alignment_target)
-
+        panel = panel_key(session_id, dash.ctx.triggered_id['index'])
+        adm = get_panel_adm(panel)
+        structured = get_panel_prompt(panel, _probe_key(dataset, scenario_id, probe_id))
+        if adm is None or structured is None:
+            return dash.no_update, dash.no_update, "Load a model and the system prompt for this probe before sweeping."
+        # A baseline ADM leaves the alignment target out of its prompt, so
+        # every target would generate the same response
+        if adm.config.instance.get('baseline', False):
+            return dash.no_update, dash.no_update, "Load the model with Aligned checked to sweep alignment targets."
         if isinstance(system_prompt, list):
             system_prompt = system_prompt[0]
+        try:
+            values = structured.parse(system_prompt)
+        except PromptEditError as e:
+            return dash.no_update, dash.no_update, f"PROMPT EDIT NOT SUPPORTED:\n{e}"
+
+        trace = Trace()
+        set_panel_trace(panel, trace)
+        with span('hydration', trace):
+            probe = get_scenario_probe(dataset, scenario_id, probe_id)
+        # Edits to the scenario apply to every target. The system prompt is
+        # what the targets change, so the ADM builds its own per target
+        # instead of using the edited one.
+        state = apply_changes(probe.state, structured.changes(values))
+        instance = copy.copy(adm.instance)
+        instance.system_ui_prompt = None
+
+        slider_values = sweep_values()
+        targets = sweep_targets(attributes, slider_values)
+        with span('prompt_build', trace):
+            jobs = {name: _sweep_job(instance, probe, state, load_alignment_target(name),
+                                     bool(choice_only) and 'choice_only' in choice_only, trace)
+                    for name in targets}
+        try:
+            _panel_queue(adm).submit_many(list(jobs.values()))
+        except QueueFull as e:
+            return dash.no_update, dash.no_update, f"SERVER BUSY: {e}, try again shortly."
+
+        chosen = {}
+        for name, job in jobs.items():
+            response = job.wait()
+            label = response.unstructured if hasattr(response, 'unstructured') else str(response).split('\n')[0]
+            for point in targets[name]:
+                chosen[point] = label
+
+        figure = sweep_figure(attributes, slider_values,
+                              [action.unstructured for action in probe.actions_filtered], chosen)
+        summary = (f"SWEEP: {len(attributes) * len(slider_values)} targets over "
+                   f"{len(targets)} distinct alignment target configs")
+        return figure, {'display': 'block'}, summary
 
-        top_level_system_prompt = system_prompt.split('\n\n')[0].split('[INST]')[1]
-        state.unstructured = system_prompt.split('\n\n')[2].split('\n')[1]
-        character_unstructured = system_prompt.split('\n\n')[1].split('\n')[1:]
-        print(character_unstructured)
-        for i, j in zip(range(len(state.characters)), range(0, len(state.characters) * 2, 2)):
-            state.characters[i].unstructured = character_unstructured[j].split(':')[1]
-            state.characters[i].intent = character_unstructured[j+1].split(':')[1]
-
-        adm_2.instance.system_ui_prompt = top_level_system_prompt
-
-        kwargs = {
-            'demo_kwargs': {
-                'max_generator_tokens': 8092,
-                'generator_seed': 2,
-                'shuffle_choices': False
-            }
-        }
-        action_taken, _ = adm_2.instance.top_level_choose_action(
-            scenario_state=state,
-            available_actions=actions_filtered,
-            alignment_target=alignment_target,
-            kdma_descriptions_map='configs/prompt_engineering/kdma_descriptions.yml',
-            tokenizer_kwargs={'truncation': False},
-            demo_kwargs=kwargs["demo_kwargs"]
-        )
-
-        actions_filtered_dicts = [action.to_dict() for action in actions_filtered]
-        action_taken_dict = action_taken.to_dict()
-        for action_gt in actions_filtered_dicts:
-            if action_gt['action_id'] == action_taken_dict['action_id']:
-                chosen_action_gt = action_gt
-                break
-
-        chosen_action_gt = chosen_action_gt["unstructured"]
-        return [
-            f"ACTION CHOICE:\n"
-            f"{chosen_action_gt}"
-            f"\n\nJUSTIFICATION:\n"
-            f"{action_taken.justification}"
-        ]
+@app.callback(
+    [Output(panel_id('timing-panel', MATCH), 'children'),
+     Output(panel_id('timing-panel', MATCH), 'style')],
+    [Input('show-timings-checklist', 'value'),
+     Input(panel_id('action-choices-prompt', MATCH), 'value'),
+     Input(panel_id('system-response', MATCH), 'value'),
+     Input(panel_id('sweep-graph', MATCH), 'figure')],
+    State('session-id', 'data'),
+    prevent_initial_call=True
+)
+def update_timing_panel(show_timings, action_choices, system_response, sweep_figure, session_id):
+    # Timings of the panel's last LOAD SYSTEM PROMPT, RUN MODEL or SWEEP,
+    # refreshed by their outputs. The editable prompt isn't an input, so
+    # typing in it doesn't call the server.
+    trace = get_panel_trace(panel_key(session_id, dash.ctx.outputs_list[0]['id']['index']))
+    if 'show' not in (show_timings or []) or trace is None:
+        return '', {'display': 'none'}
+    return trace.text(), {'display': 'block', 'font-size': 18}
 
 if __name__ == '__main__':
     app.run_server(debug=True, port=8052)
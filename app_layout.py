@@ -11,297 +11,252 @@ def list_json_files(dir_path='oracle-json-files'):
     return [str(file) for file in os.listdir(dir_path) if file.endswith('.json')]
 
 def list_llm_backbones():
-    return ['mistralai/Mistral-7B-Instruct-v0.2', 'meta-llama/Meta-Llama-3-8B-Instruct']
+    # The SmolLM2 backbone is small enough to run on CPU, for CI and laptops
+    return ['mistralai/Mistral-7B-Instruct-v0.2', 'meta-llama/Meta-Llama-3-8B-Instruct',
+            'HuggingFaceTB/SmolLM2-135M-Instruct']
+
+# Weight precisions and devices a panel can load its backbone with (see
+# model_pool.PRECISIONS); unset uses the ADM config's
+def list_precisions():
+    return ['full', 'half', 'int8', '4bit']
+
+def list_devices():
+    return ['auto', 'cpu', 'cuda:0', 'cuda:1']
 
 # Define the attributes and initial values
 attributes = ['moral_deservingness', 'maximization']
 num_attributes = len(attributes)
 initial_values = [5] * num_attributes
 
+# Number of model panels that can be compared side by side
+MIN_PANELS = 2
+MAX_PANELS = 6
 
-load_dataset_components = (
-    dbc.Col([
-        html.Label('Input Dataset:', className='mb-2', style={'font-size': 25}),
-        dcc.Dropdown(
-            id='dataset-dropdown',
-            options=[{'label': i, 'value': i} for i in list_json_files()],
-            placeholder="Select Dataset...",
-            style={"height": '40px',
-                'font-size': 22}
-        )
-    ]),
-    dbc.Col([
-        html.Label('Scenario ID:', className='mb-2', style={'font-size': 25}),
-        dcc.Dropdown(
-            id='scenario-id-dropdown',
-            options=[],
-            placeholder='Select a Scenario ID...',
-            className='mr-3',
-            style={"height": '40px',
-                'font-size': 22}
-        ),
-    ]),
-    dbc.Col([
-        html.Label('Probe ID:', className='mb-2', style={'font-size': 25}),
-        dcc.Dropdown(
-            id='probe-id-dropdown',
-            options=[],
-            placeholder='Select a probe ID...',
-            className='mr-3',
-            style={"height": '40px',
-                'font-size': 22}
 
-        )
-    ])
-)
+def panel_id(component, index):
+    # Pattern-matching ID of a component in the model panel at index
+    return {'type': component, 'index': index}
 
-model_1_layout = (
-    dbc.Stack([
+
+def load_dataset_components():
+    # Built per page load so datasets added to the directory show up
+    # without restarting the server
+    return (
         dbc.Col([
-            html.Label('LLM Chat backbone:', className='mb-1', style={'font-size': 22}),
+            html.Label('Input Dataset:', className='mb-2', style={'font-size': 25}),
             dcc.Dropdown(
-                id='llm-dropdown',
-                options=[{'label': i, 'value': i} for i in list_llm_backbones()],
-                className='dropdown-class-1',
-                placeholder='Select LLM chat backbone',
-                style={'font-size': 22, 'width': '100%'}
-            ),
+                id='dataset-dropdown',
+                options=[{'label': i, 'value': i} for i in list_json_files()],
+                placeholder="Select Dataset...",
+                style={"height": '40px',
+                    'font-size': 22}
+            )
         ]),
         dbc.Col([
-            html.Label('Algorithm:', className='mb-2', style={'font-size': 22}),
+            html.Label('Scenario ID:', className='mb-2', style={'font-size': 25}),
             dcc.Dropdown(
-                id='adm-config-input',
-                options=[
-                    {'label': filename, 'value': filename}
-                    for filename in list_adms()
-                ],
-                className='dropdown-class-1',
-                placeholder='Select Algorithm..',
-                style={'font-size': 22, 'width': '100%'}
+                id='scenario-id-dropdown',
+                options=[],
+                placeholder='Select a Scenario ID...',
+                className='mr-3',
+                style={"height": '40px',
+                    'font-size': 22}
             ),
         ]),
-        dcc.Checklist(
-            id='system-prompt-checklist',
-            options=[
-                {'label': 'Aligned', 'value': 'aligned'},
-            ],
-            className='mt-4',
-            style={'font-size': 22}
-        ),
-        dcc.Loading(
-            id="loading-indicator-model",
-            children=[
-                dbc.Button('LOAD MODEL', id='load-model-button',
-                            color='primary', className='mt-5'),
-            ],
-            type="default",
-        ),
-    ], direction='horizontal', gap=3),
-    html.Hr(),
-    dbc.Stack([
-        html.Label('Alignment Attribute Target:', className='mb-2', style={'font-size': 22}),
-        dcc.Dropdown(
-            id='kdma-dropdown',
-            options=[{'label': i, 'value': i} for i in attributes],
-            className='dropdown-class-1',
-            placeholder='Select Alignment Attribute...',
-            style={'font-size': 22, 'width': '100%'}
-        ),
-    ], id='alignment-target-stack', direction='vertical', gap=3, style={'display': 'none'}),
-    html.Div([
-        dcc.Slider(0, 1, 0.1,
-            value=0.8,
-            id='kdma-slider',
-        ),
-    ], id='slider-div', style={'display': 'none'}),
-
-    html.Div(id='space-div', style={'display': 'block', 'marginBottom': '170px'}),
-
-    html.Hr(),
-     dcc.Loading(
-        id="loading-indicator-system-prompt",
-        children=[
-            dbc.Button('LOAD SYSTEM PROMPT', id='load-system-prompt-button', color='primary', className='mb-1'),
-        ],
-        type="default",
-    ),
-    dbc.Row([
         dbc.Col([
-            html.Label('Prompt:', className='mt-2', style={'font-size': 25}),
-            dbc.Textarea(
-                id='system-prompt',
-                value="",
-                readOnly=False,
-                className='mb-3',
-                style={'height': '600px', 'font-size': 22},
-            ),
-        ]),
-    ]),
+            html.Label('Probe ID:', className='mb-2', style={'font-size': 25}),
+            dcc.Dropdown(
+                id='probe-id-dropdown',
+                options=[],
+                placeholder='Select a probe ID...',
+                className='mr-3',
+                style={"height": '40px',
+                    'font-size': 22}
 
-    dbc.Row([
+            )
+        ]),
         dbc.Col([
-            html.Label('Action Choices (READ-ONLY):', className='mt-2', style={'font-size': 25}),
-            dbc.Textarea(
-                id='action-choices-prompt',
-                value="",
-                readOnly=True,
-                className='mb-3',
-                style={'height': '200px', 'font-size': 22},
+            html.Label('Models:', className='mb-2', style={'font-size': 25}),
+            dcc.Dropdown(
+                id='num-panels-dropdown',
+                options=[{'label': str(i), 'value': i} for i in range(MIN_PANELS, MAX_PANELS + 1)],
+                value=MIN_PANELS,
+                clearable=False,
+                style={"height": '40px',
+                    'font-size': 22}
             ),
-        ]),
-    ]),
-
-    dbc.Row([
+        ], width=1),
         dbc.Col([
             dcc.Loading(
-                id="loading-indicator-run",
+                id="loading-indicator-run-all",
                 children=[
-                    dbc.Button('RUN MODEL', id='run-button', color='primary', className='mb-3'),
+                    dbc.Button('RUN ALL', id='run-all-button', color='primary', className='mt-5'),
                 ],
                 type="default"
             ),
-        ]),
-    ]),
-
-    dbc.Row([
-        dbc.Col([
-            html.Label('System Response:', className='mb-2', style={'font-size': 25}),
-            dcc.Loading(
-                id="loading-indicator-response",
-                children=[
-                    dbc.Textarea(
-                        id='system-response',
-                        readOnly=False,
-                        className='mb-3',
-                        style={'height': '300px', 'font-size': 22}
-                    ),
-            ], type="default"),
-        ]),
-    ]),
-)
-
+        ], width='auto'),
+        dcc.Checklist(
+            id='show-timings-checklist',
+            options=[{'label': 'Show timings', 'value': 'show'}],
+            value=[],
+            className='mt-5',
+            style={'font-size': 22}
+        ),
+    )
 
-model_2_layout = (
-    dbc.Stack([
-        dbc.Col([
-            html.Label('LLM Chat backbone:', className='mb-1', style={'font-size': 22}),
-            dcc.Dropdown(
-                id='llm-dropdown-2',
-                options=[{'label': i, 'value': i} for i in list_llm_backbones()],
-                className='dropdown-class-1',
-                placeholder='Select LLM chat backbone',
-                style={'font-size': 22, 'width': '100%'}
-            ),
-        ]),
-        dbc.Col([
-            html.Label('Algorithm:', className='mb-2', style={'font-size': 22}),
-            dcc.Dropdown(
-                id='adm-config-input-2',
+def model_panel_layout(index):
+    return (
+        html.H3(f'Model {index + 1}', className='mb-3'),
+        dcc.Store(id=panel_id('alignment-target-store', index)),
+        dbc.Stack([
+            dbc.Col([
+                html.Label('LLM Chat backbone:', className='mb-1', style={'font-size': 22}),
+                dcc.Dropdown(
+                    id=panel_id('llm-dropdown', index),
+                    options=[{'label': i, 'value': i} for i in list_llm_backbones()],
+                    className='dropdown-class-1',
+                    placeholder='Select LLM chat backbone',
+                    style={'font-size': 22, 'width': '100%'}
+                ),
+            ]),
+            dbc.Col([
+                html.Label('Algorithm:', className='mb-2', style={'font-size': 22}),
+                dcc.Dropdown(
+                    id=panel_id('adm-config-input', index),
+                    options=[
+                        {'label': filename, 'value': filename}
+                        for filename in list_adms()
+                    ],
+                    className='dropdown-class-1',
+                    placeholder='Select Algorithm..',
+                    style={'font-size': 22, 'width': '100%'}
+                ),
+            ]),
+            dbc.Col([
+                html.Label('Precision:', className='mb-2', style={'font-size': 22}),
+                dcc.Dropdown(
+                    id=panel_id('precision-dropdown', index),
+                    options=[{'label': i, 'value': i} for i in list_precisions()],
+                    className='dropdown-class-1',
+                    placeholder='Config default',
+                    style={'font-size': 22, 'width': '100%'}
+                ),
+            ]),
+            dbc.Col([
+                html.Label('Device:', className='mb-2', style={'font-size': 22}),
+                dcc.Dropdown(
+                    id=panel_id('device-dropdown', index),
+                    options=[{'label': i, 'value': i} for i in list_devices()],
+                    className='dropdown-class-1',
+                    placeholder='Config default',
+                    style={'font-size': 22, 'width': '100%'}
+                ),
+            ]),
+            dcc.Checklist(
+                id=panel_id('system-prompt-checklist', index),
                 options=[
-                    {'label': filename, 'value': filename}
-                    for filename in list_adms()
+                    {'label': 'Aligned', 'value': 'aligned'},
                 ],
+                className='mt-4',
+                style={'font-size': 22}
+            ),
+            dbc.Button('LOAD MODEL', id=panel_id('load-model-button', index),
+                        color='primary', className='mt-5'),
+        ], direction='horizontal', gap=3),
+        html.Div(id=panel_id('model-load-status', index), className='mt-2',
+                 style={'font-size': 18, 'white-space': 'pre-line'}),
+        dcc.Interval(id=panel_id('model-load-interval', index), interval=1000, disabled=True),
+        html.Hr(),
+        dbc.Stack([
+            html.Label('Alignment Attribute Target:', className='mb-2', style={'font-size': 22}),
+            dcc.Dropdown(
+                id=panel_id('kdma-dropdown', index),
+                options=[{'label': i, 'value': i} for i in attributes],
                 className='dropdown-class-1',
-                placeholder='Select Algorithm..',
+                placeholder='Select Alignment Attribute...',
                 style={'font-size': 22, 'width': '100%'}
             ),
-        ]),
-        dcc.Checklist(
-            id='system-prompt-checklist-2',
-            options=[
-                {'label': 'Aligned', 'value': 'aligned'},
-            ],
-            className='mt-4',
-            style={'font-size': 22}
-        ),
+        ], id=panel_id('alignment-target-stack', index), direction='vertical', gap=3, style={'display': 'none'}),
+        html.Div([
+            dcc.Slider(0, 1, 0.1,
+                value=0.8,
+                id=panel_id('kdma-slider', index),
+            ),
+        ], id=panel_id('slider-div', index), style={'display': 'none'}),
+
+        html.Div(id=panel_id('space-div', index), style={'display': 'block', 'marginBottom': '170px'}),
+
+        html.Hr(),
         dcc.Loading(
-            id="loading-indicator-model-2",
+            id=panel_id('loading-indicator-system-prompt', index),
             children=[
-                dbc.Button('LOAD MODEL', id='load-model-button-2',
-                            color='primary', className='mt-5'),
+                dbc.Button('LOAD SYSTEM PROMPT', id=panel_id('load-system-prompt-button', index), color='primary', className='mb-1'),
             ],
             type="default",
         ),
-    ], direction='horizontal', gap=3),
-    html.Hr(),
-    dbc.Stack([
-        html.Label('Alignment Attribute Target:', className='mb-2', style={'font-size': 22}),
-        dcc.Dropdown(
-            id='kdma-dropdown-2',
-            options=[{'label': i, 'value': i} for i in attributes],
-            className='dropdown-class-1',
-            placeholder='Select Alignment Attribute',
-            style={'font-size': 22, 'width': '100%'}
-        ),
-    ], id='alignment-target-stack-2', direction='vertical', gap=3, style={'display': 'none'}),
-    html.Div([
-        dcc.Slider(0, 1, 0.1,
-            value=0.8,
-            id='kdma-slider-2',
-        ),
-    ], id='slider-div-2', style={'display': 'none'}),
-
-    html.Div(id='space-div-2', style={'display': 'block', 'marginBottom': '170px'}),
-
-    html.Hr(),
-    dcc.Loading(
-        id="loading-indicator-system-prompt-2",
-        children=[
-            dbc.Button('LOAD SYSTEM PROMPT', id='load-system-prompt-button-2', color='primary', className='mb-1'),
-        ],
-        type="default",
-    ),
-    dbc.Row([
-        dbc.Col([
-            html.Label('Prompt:', className='mt-2', style={'font-size': 25}),
-            dbc.Textarea(
-                id='system-prompt-2',
-                value="",
-                readOnly=False,
-                className='mb-3',
-                style={'height': '600px', 'font-size': 22}
-            ),
-        ]),
-    ]),
-
-    dbc.Row([
-        dbc.Col([
-            html.Label('Action Choices (READ-ONLY):', className='mt-2', style={'font-size': 25}),
-            dbc.Textarea(
-                id='action-choices-prompt-2',
-                value="",
-                readOnly=True,
-                className='mb-3',
-                style={'height': '200px', 'font-size': 22},
-            ),
+        dbc.Row([
+            dbc.Col([
+                html.Label('Prompt:', className='mt-2', style={'font-size': 25}),
+                dbc.Textarea(
+                    id=panel_id('system-prompt', index),
+                    value="",
+                    readOnly=False,
+                    className='mb-3',
+                    style={'height': '600px', 'font-size': 22},
+                ),
+            ]),
         ]),
-    ]),
 
-    dbc.Row([
-        dbc.Col([
-            dcc.Loading(
-                id="loading-indicator-run-2",
-                children=[
-                    dbc.Button('RUN MODEL', id='run-button-2', color='primary', className='mb-3'),
-                ],
-                type="default"
-            ),
+        dbc.Row([
+            dbc.Col([
+                html.Label('Action Choices (READ-ONLY):', className='mt-2', style={'font-size': 25}),
+                dbc.Textarea(
+                    id=panel_id('action-choices-prompt', index),
+                    value="",
+                    readOnly=True,
+                    className='mb-3',
+                    style={'height': '200px', 'font-size': 22},
+                ),
+            ]),
         ]),
-    ]),
 
-    dbc.Row([
-        dbc.Col([
-            html.Label('System Response:', className='mb-2', style={'font-size': 25}),
-            dcc.Loading(
-                id="loading-indicator-response-2",
-                children=[
-                    dbc.Textarea(
-                        id='system-response-2',
-                        readOnly=False,
+        dbc.Row([
+            dbc.Col([
+                dbc.Stack([
+                    dbc.Button('RUN MODEL', id=panel_id('run-button', index), color='primary', className='mb-3'),
+                    dbc.Button('STOP', id=panel_id('stop-button', index), color='danger', className='mb-3', disabled=True),
+                    dbc.Button('JUSTIFY', id=panel_id('justify-button', index), color='secondary', className='mb-3'),
+                    dbc.Button('SWEEP', id=panel_id('sweep-button', index), color='secondary', className='mb-3'),
+                    dcc.Checklist(
+                        id=panel_id('choice-only-checklist', index),
+                        options=[{'label': 'Choice only', 'value': 'choice_only'}],
+                        value=[],
                         className='mb-3',
-                        style={'height': '300px', 'font-size': 22}
+                        style={'font-size': 22}
                     ),
-            ], type="default"),
+                ], direction='horizontal', gap=3),
+                dcc.Interval(id=panel_id('response-stream-interval', index), interval=300, disabled=True),
+            ]),
+        ]),
+
+        dbc.Row([
+            dbc.Col([
+                html.Label('System Response:', className='mb-2', style={'font-size': 25}),
+                dbc.Textarea(
+                    id=panel_id('system-response', index),
+                    readOnly=False,
+                    className='mb-3',
+                    style={'height': '300px', 'font-size': 22}
+                ),
+            ]),
         ]),
-    ]),
-)
+        dcc.Loading(
+            id=panel_id('loading-indicator-sweep', index),
+            children=[
+                dcc.Graph(id=panel_id('sweep-graph', index), style={'display': 'none'},
+                          config={'displayModeBar': False}),
+            ],
+            type="default",
+        ),
+        html.Pre(id=panel_id('timing-panel', index), style={'display': 'none', 'font-size': 18}),
+    )
@@ -0,0 +1,223 @@
+import argparse
+from concurrent.futures import as_completed
+import json
+import os
+from types import SimpleNamespace
+
+from omegaconf import OmegaConf
+import torch
+
+from adm_generation import (
+    KDMA_DESCRIPTIONS_MAP,
+    GenerationRun,
+    can_batch,
+    choose_action_choice_only,
+    choose_actions_batched,
+)
+from alignment_targets import ALIGNMENT_TARGET_DIR, load_alignment_target
+from model_pool import PRECISIONS, get_adm, load_adm_config
+from oracle_loader import OracleDataset
+from probe_index import hydrate_probe
+from worker_pool import WorkerPool
+
+
+def iter_probes(dataset, completed=()):
+    # Probe IDs come from the dataset catalog, so completed probes are
+    # skipped without decoding or hydrating their records
+    for scenario_id in dataset.scenario_ids:
+        for record_index, entry in enumerate(dataset.probes(scenario_id)):
+            if (scenario_id, entry['probe_id']) in completed:
+                continue
+            record = dataset.read(entry)
+            yield scenario_id, record_index, record, hydrate_probe(record, entry['probe_id'])
+
+
+def load_completed(output_path):
+    '''
+    (scenario_id, probe_id) pairs already written to output_path. A partial
+    last line left by an interrupted run is truncated so the run can resume
+    appending to the file.
+    '''
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+
+    with open(output_path, 'rb+') as f:
+        content = f.read()
+        if content and not content.endswith(b'\n'):
+            f.truncate(content.rfind(b'\n') + 1)
+            content = content[:content.rfind(b'\n') + 1]
+
+    for line in content.decode().splitlines():
+        result = json.loads(line)
+        completed.add((result['scenario_id'], result['probe_id']))
+    return completed
+
+
+def choose_actions(adm, batch, alignment_target, demo_kwargs, choice_only=False):
+    runs = []
+    for _, _, probe in batch:
+        dialog_texts, _ = adm.instance.get_dialog_texts(
+            scenario_state=probe.state,
+            available_actions=probe.actions_filtered,
+            alignment_target=alignment_target,
+            kdma_descriptions_map=KDMA_DESCRIPTIONS_MAP,
+            demo_kwargs=demo_kwargs
+        )
+        runs.append(GenerationRun(adm.instance, dialog_texts[0], probe.state, probe.actions_filtered))
+
+    if choice_only and can_batch(runs):
+        # Scores the choices only, leaving out the justification
+        return [choose_action_choice_only(run) for run in runs]
+    if can_batch(runs):
+        return choose_actions_batched(runs, demo_kwargs)
+
+    actions_taken = []
+    for run in runs:
+        action_taken, _ = adm.instance.top_level_choose_action(
+            scenario_state=run.scenario_state,
+            available_actions=run.available_actions,
+            alignment_target=alignment_target,
+            kdma_descriptions_map=KDMA_DESCRIPTIONS_MAP,
+            tokenizer_kwargs={'truncation': False},
+            demo_kwargs=demo_kwargs)
+        actions_taken.append(action_taken)
+    return actions_taken
+
+
+def format_result(dataset_name, scenario_id, record, probe, action_taken):
+    # Mirrors the oracle record's output so results can be compared
+    # directly against its output/label
+    choice = next(i for i, c in enumerate(record['input']['choices'])
+                  if c['action_id'] == action_taken.action_id)
+    return {
+        'dataset': dataset_name,
+        'scenario_id': scenario_id,
+        'probe_id': probe.probe_id,
+        'output': {
+            'choice': choice,
+            'action': action_taken.to_dict(),
+        },
+        'label': record['label'],
+        'reference_output': record['output'],
+    }
+
+
+def _pending_batches(dataset, completed, batch_size, per_scenario=False):
+    batch = []
+    for scenario_id, record_index, record, probe in iter_probes(dataset, completed):
+        if batch and (len(batch) == batch_size or
+                      (per_scenario and batch[-1][0] != scenario_id)):
+            yield batch
+            batch = []
+        batch.append((scenario_id, record_index, record, probe))
+    if batch:
+        yield batch
+
+
+def _write_results(f, results):
+    for result in results:
+        f.write(json.dumps(result) + '\n')
+    # Checkpoint after every batch so an interrupted sweep resumes from here
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def evaluate_dataset(dataset_path, adm, output_path, alignment_target=None, batch_size=8,
+                     worker_pool=None, choice_only=False):
+    dataset = OracleDataset(dataset_path)
+    dataset_name = os.path.basename(dataset_path)
+    demo_kwargs = OmegaConf.to_container(adm.config.demo_kwargs)
+
+    completed = load_completed(output_path)
+    print(f"{dataset_name}: skipping {len(completed)} completed probes")
+
+    if os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, 'a') as f:
+        num_done = 0
+        if worker_pool is None:
+            for batch in _pending_batches(dataset, completed, batch_size):
+                batch = [(scenario_id, record, probe) for scenario_id, _, record, probe in batch]
+                actions_taken = choose_actions(adm, batch, alignment_target, demo_kwargs, choice_only)
+                _write_results(f, [format_result(dataset_name, *probe, action_taken)
+                                   for probe, action_taken in zip(batch, actions_taken)])
+                num_done += len(batch)
+                print(f"{dataset_name}: {num_done} probes done")
+        else:
+            # Workers hydrate probes themselves; only (scenario_id, record
+            # indices) chunks are sent to them
+            probe_chunks = [(batch[0][0], [record_index for _, record_index, _, _ in batch])
+                            for batch in _pending_batches(dataset, completed, batch_size, per_scenario=True)]
+            aligned = not adm.config.instance.get('baseline', False)
+            for future in as_completed(worker_pool.map_probes(dataset_path, probe_chunks, aligned,
+                                                              alignment_target, demo_kwargs,
+                                                              choice_only)):
+                results = future.result()
+                _write_results(f, results)
+                num_done += len(results)
+                print(f"{dataset_name}: {num_done} probes done")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run an ADM over every probe of oracle datasets')
+    parser.add_argument('datasets', nargs='+', help='Oracle input/output JSON files')
+    parser.add_argument('--llm-backbone', default='mistralai/Mistral-7B-Instruct-v0.2')
+    parser.add_argument('--adm', default='outlines_transformers_structured')
+    parser.add_argument('--aligned', action='store_true')
+    parser.add_argument('--alignment-target', default=None,
+                        help=f"Alignment target config name in {ALIGNMENT_TARGET_DIR}, e.g. maximization_high")
+    parser.add_argument('--precision', choices=list(PRECISIONS), default=None,
+                        help='Weight precision; int8 and 4bit need a GPU')
+    parser.add_argument('--device', default=None,
+                        help='Device the backbone loads on (e.g. cpu, cuda:0) when not using --devices')
+    parser.add_argument('--choice-only', action='store_true',
+                        help='Only score the action choices, without generating justifications')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--output-dir', default='outputs')
+    parser.add_argument('--devices', nargs='+', default=None,
+                        help='Run one ADM worker process per device (e.g. cuda:0 cuda:1) '
+                             'and shard probes across them')
+    args = parser.parse_args()
+
+    # Same torch determinism as the app so results match the UI
+    os.environ["CUBLAS_WORKSPACE_CONFIG"] = ":4096:8"
+    torch.use_deterministic_algorithms(True)
+
+    worker_pool = None
+    if args.devices:
+        worker_pool = WorkerPool(args.llm_backbone, args.adm, devices=args.devices,
+                                 precision=args.precision)
+        # The dispatcher only needs the config; the weights live in the
+        # worker processes
+        adm = SimpleNamespace(config=load_adm_config(args.adm, args.aligned, args.llm_backbone,
+                                                     args.precision))
+    else:
+        adm = get_adm(args.llm_backbone, args.adm, args.aligned, args.precision, args.device)
+    alignment_target = load_alignment_target(args.alignment_target)
+
+    run_name = f"{args.llm_backbone.replace('/', '_')}_{'aligned' if args.aligned else 'baseline'}"
+    if args.alignment_target is not None:
+        run_name += f"_{args.alignment_target}"
+    if args.precision is not None:
+        run_name += f"_{args.precision}"
+    if args.choice_only:
+        run_name += "_choice_only"
+
+    for dataset_path in args.datasets:
+        dataset_name = os.path.splitext(os.path.basename(dataset_path))[0]
+        evaluate_dataset(
+            dataset_path,
+            adm,
+            os.path.join(args.output_dir, f"{dataset_name}_{run_name}.jsonl"),
+            alignment_target=alignment_target,
+            batch_size=args.batch_size,
+            worker_pool=worker_pool,
+            choice_only=args.choice_only)
+
+    if worker_pool is not None:
+        worker_pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+'''
+Micro-benchmark of filter_actions against the previous per-action
+implementation on synthetic states with hundreds of characters and actions.
+
+    python -m benchmarks.bench_filter_actions
+'''
+import argparse
+from copy import deepcopy
+import random
+import timeit
+from types import SimpleNamespace
+
+from swagger_client.models import Action, ActionTypeEnum
+
+from action_filtering import filter_actions
+
+TREATMENTS = ['Hemostatic gauze', 'Tourniquet', 'Pressure bandage', 'Decompression Needle',
+              'Nasopharyngeal airway', 'Pulse Oximeter', 'Blanket', 'Epi Pen',
+              'Vented Chest Seal', 'Pain Medications', 'Splint', 'Blood']
+ACTION_TYPES = [ActionTypeEnum.APPLY_TREATMENT, ActionTypeEnum.CHECK_ALL_VITALS,
+                ActionTypeEnum.CHECK_PULSE, ActionTypeEnum.CHECK_RESPIRATION,
+                ActionTypeEnum.MOVE_TO_EVAC, ActionTypeEnum.TAG_CHARACTER,
+                ActionTypeEnum.CHECK_BLOOD_OXYGEN, ActionTypeEnum.DIRECT_MOBILE_CHARACTERS]
+
+
+def reference_filter_actions(current_state, available_actions, noop_actions=None):
+    # filter_actions before precomputing state facts, kept for comparison
+    noop_actions = noop_actions or []
+    available_actions_filtered = []
+    for a in available_actions:
+        if len(current_state.characters) == 0:
+            if a.action_type in {ActionTypeEnum.APPLY_TREATMENT,
+                                 ActionTypeEnum.CHECK_ALL_VITALS,
+                                 ActionTypeEnum.CHECK_PULSE,
+                                 ActionTypeEnum.CHECK_RESPIRATION,
+                                 ActionTypeEnum.MOVE_TO_EVAC,
+                                 ActionTypeEnum.TAG_CHARACTER,
+                                 ActionTypeEnum.CHECK_BLOOD_OXYGEN}:
+                continue
+
+        if a.action_type == ActionTypeEnum.TAG_CHARACTER:
+            untagged_characters = [c for c in current_state.characters
+                                   if c.tag is None and not c.unseen]
+            if len(untagged_characters) == 0:
+                continue
+
+        unvisited_characters = [c for c in current_state.characters
+                                if not c.unseen and (c.visited is None or not c.visited)]
+        if a.action_type in {ActionTypeEnum.CHECK_ALL_VITALS,
+                             ActionTypeEnum.CHECK_PULSE,
+                             ActionTypeEnum.CHECK_RESPIRATION,
+                             ActionTypeEnum.CHECK_BLOOD_OXYGEN}:
+            if len(unvisited_characters) == 0:
+                continue
+
+        if (
+            a.action_type == ActionTypeEnum.APPLY_TREATMENT and
+            a.parameters is not None and 'treatment' in a.parameters
+        ):
+            treatment_available = False
+            for s in current_state.supplies:
+                if a.parameters['treatment'] == s.type:
+                    if s.quantity > 0:
+                        treatment_available = True
+                    break
+
+            if not treatment_available:
+                continue
+
+        is_a_noop_action = False
+        for noop_action in noop_actions:
+            if a == noop_action:
+                is_a_noop_action = True
+
+            if noop_action.action_type == ActionTypeEnum.APPLY_TREATMENT:
+                _tmp_noop_action = deepcopy(noop_action)
+
+                _tmp_noop_action.parameters = None
+                _tmp_noop_action.character_id = None
+
+                if a == _tmp_noop_action:
+                    is_a_noop_action = True
+
+        if is_a_noop_action:
+            continue
+
+        available_actions_filtered.append(a)
+
+    return available_actions_filtered
+
+
+def synthetic_state(num_characters, num_supplies, rng):
+    characters = [
+        SimpleNamespace(id=f"casualty_{i}",
+                        tag=rng.choice([None, 'MINIMAL', 'DELAYED']),
+                        unseen=rng.random() < 0.1,
+                        visited=rng.choice([None, True, False]))
+        for i in range(num_characters)]
+    supplies = [
+        SimpleNamespace(type=f"{TREATMENTS[i % len(TREATMENTS)]} {i // len(TREATMENTS)}",
+                        quantity=rng.randint(0, 3))
+        for i in range(num_supplies)]
+    return SimpleNamespace(characters=characters, supplies=supplies, scenario_complete=False)
+
+
+def synthetic_actions(state, num_actions, rng):
+    actions = []
+    for i in range(num_actions):
+        action_type = rng.choice(ACTION_TYPES)
+        character = rng.choice(state.characters)
+        parameters = None
+        if action_type == ActionTypeEnum.APPLY_TREATMENT:
+            parameters = {'treatment': rng.choice(state.supplies).type, 'location': 'left forearm'}
+        actions.append(Action(action_id=f"action_{i}", action_type=action_type,
+                              character_id=character.id, parameters=parameters))
+    return actions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--characters', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--actions', type=int, default=500)
+    parser.add_argument('--supplies', type=int, default=200)
+    parser.add_argument('--noops', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    print(f"{'characters':>10} {'actions':>8} {'noops':>6} {'reference ms':>13} {'filter_actions ms':>18} {'speedup':>8}")
+    for num_characters in args.characters:
+        state = synthetic_state(num_characters, args.supplies, rng)
+        actions = synthetic_actions(state, args.actions, rng)
+        noop_actions = rng.sample(actions, min(args.noops, len(actions)))
+
+        assert (reference_filter_actions(state, actions, noop_actions) ==
+                filter_actions(state, actions, noop_actions))
+
+        reference = min(timeit.repeat(lambda: reference_filter_actions(state, actions, noop_actions),
+                                      number=1, repeat=args.repeat))
+        optimized = min(timeit.repeat(lambda: filter_actions(state, actions, noop_actions),
+                                      number=1, repeat=args.repeat))
+        print(f"{num_characters:>10} {args.actions:>8} {len(noop_actions):>6} "
+              f"{reference * 1000:>13.2f} {optimized * 1000:>18.2f} {reference / optimized:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
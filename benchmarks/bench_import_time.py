@@ -0,0 +1,78 @@
+'''
+Cold-start import time of the app's modules, each imported in a fresh
+interpreter, and which heavy libraries each import pulls in. Pass --ref to
+compare against another git revision (e.g. the commit before lazy imports).
+
+    python -m benchmarks.bench_import_time --ref HEAD~1
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+MODULES = ['app', 'dataset_registry', 'action_filtering']
+HEAVY_MODULES = ['torch', 'transformers', 'outlines', 'hydra', 'align_system', 'swagger_client', 'rich']
+
+_TIMER = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(json.dumps({{'seconds': elapsed, 'heavy': heavy}}))
+'''
+
+
+def time_import(module, cwd, repeat):
+    timings = []
+    heavy = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-c', _TIMER.format(module=module, heavy=HEAVY_MODULES)],
+                                cwd=cwd, capture_output=True, text=True)
+        if result.returncode != 0:
+            return None, result.stderr.strip().splitlines()[-1]
+        timing = json.loads(result.stdout.strip().splitlines()[-1])
+        timings.append(timing['seconds'])
+        heavy = timing['heavy']
+    return statistics.median(timings), heavy
+
+
+def checkout(ref, path):
+    archive = subprocess.run(['git', 'archive', '--format=tar', ref], capture_output=True, check=True).stdout
+    with tempfile.TemporaryFile() as f:
+        f.write(archive)
+        f.seek(0)
+        with tarfile.open(fileobj=f) as tar:
+            tar.extractall(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('--ref', help='Git revision to compare against')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    trees = [('current', os.getcwd())]
+    with tempfile.TemporaryDirectory() as ref_dir:
+        if args.ref:
+            checkout(args.ref, ref_dir)
+            trees.insert(0, (args.ref, ref_dir))
+
+        print(f"{'tree':>10} {'module':>18} {'import s':>9}  heavy imports")
+        for name, cwd in trees:
+            for module in args.modules:
+                seconds, heavy = time_import(module, cwd, args.repeat)
+                if seconds is None:
+                    print(f"{name:>10} {module:>18} {'failed':>9}  {heavy}")
+                else:
+                    print(f"{name:>10} {module:>18} {seconds:>9.2f}  {', '.join(heavy) or '-'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+'''
+Per-stage timings of a panel run with a deterministic stub ADM (FakeADM)
+standing in for the model, so it runs offline on CPU: dataset load,
+hydration, filter_actions, prompt construction, generation and response
+formatting. Runs over the bundled oracle files and synthetic datasets
+scaled up from them, and writes the results as JSON for regression
+tracking.
+
+    python -m benchmarks.bench_pipeline --scale 4 16 --output bench_pipeline.json
+'''
+import argparse
+import copy
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+
+from action_filtering import filter_actions
+from fake_adm import FakeADM
+from oracle_loader import OracleDataset
+from probe_index import hydrate_probe
+from prompt_model import structure_prompt
+from response_format import format_response
+
+DATASET_DIR = 'oracle-json-files'
+# Records per scenario in synthetic datasets
+SYNTHETIC_SCENARIO_SIZE = 16
+
+
+def synthetic_records(records, scale, extra_characters):
+    '''
+    scale copies of records, regrouped into new scenarios, each record
+    with extra_characters copies of its characters and of the actions
+    targeting them
+    '''
+    synthetic = []
+    for i in range(len(records) * scale):
+        record = copy.deepcopy(records[i % len(records)])
+        record['input']['scenario_id'] = f"synthetic.{i // SYNTHETIC_SCENARIO_SIZE}"
+        full_state = record['input']['full_state']
+        characters = list(full_state['characters'])
+        choices = list(record['input']['choices'])
+        for n in range(1, extra_characters + 1):
+            for character in full_state['characters']:
+                clone = copy.deepcopy(character)
+                clone['id'] = f"{character['id']} ({n})"
+                clone['name'] = f"{character['name']} ({n})"
+                characters.append(clone)
+                for choice in record['input']['choices']:
+                    if choice.get('character_id') == character['id']:
+                        choice = copy.deepcopy(choice)
+                        choice['action_id'] = f"{choice['action_id']}_{n}"
+                        choice['character_id'] = clone['id']
+                        choices.append(choice)
+        full_state['characters'] = characters
+        record['input']['choices'] = choices
+        synthetic.append(record)
+    return synthetic
+
+
+def _summary(timings):
+    timings = sorted(timings)
+    return {
+        'count': len(timings),
+        'total_s': sum(timings),
+        'mean_ms': statistics.mean(timings) * 1000 if timings else 0.0,
+        'p95_ms': timings[int(0.95 * (len(timings) - 1))] * 1000 if timings else 0.0,
+    }
+
+
+def _timed(stage_timings, stage, fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    stage_timings[stage].append(time.perf_counter() - start)
+    return result
+
+
+def bench_dataset(path, adm, max_probes=None):
+    stages = ['catalog_build', 'catalog_load', 'record_decode', 'hydration',
+              'filter_actions', 'prompt', 'generation', 'formatting']
+    timings = {stage: [] for stage in stages}
+
+    # Dataset load: a cold catalog build and a load of the cached catalog
+    catalog_path = f"{path}.catalog"
+    if os.path.exists(catalog_path):
+        os.remove(catalog_path)
+    _timed(timings, 'catalog_build', OracleDataset, path)
+    dataset = _timed(timings, 'catalog_load', OracleDataset, path)
+
+    probes = [(scenario_id, entry) for scenario_id in dataset.scenario_ids
+              for entry in dataset.probes(scenario_id)]
+    for scenario_id, entry in probes[:max_probes]:
+        record = _timed(timings, 'record_decode', dataset.read, entry)
+        probe = _timed(timings, 'hydration', hydrate_probe, record, entry['probe_id'])
+        # hydrate_probe filters too; timed again on its own
+        actions_filtered = _timed(timings, 'filter_actions', filter_actions, probe.state, probe.actions)
+
+        def build_prompt():
+            prompts, _ = adm.get_dialog_texts(probe.state, actions_filtered, None)
+            return structure_prompt(prompts[0], probe.state)
+        _timed(timings, 'prompt', build_prompt)
+
+        action_taken, _ = _timed(timings, 'generation', adm.top_level_choose_action,
+                                 probe.state, actions_filtered, None)
+        _timed(timings, 'formatting', format_response, actions_filtered, action_taken)
+
+    num_records = sum(len(dataset.probes(s)) for s in dataset.scenario_ids)
+    return {
+        'dataset': os.path.basename(path),
+        'size_bytes': os.path.getsize(path),
+        'scenarios': len(dataset.scenario_ids),
+        'records': num_records,
+        'stages': {stage: _summary(timings[stage]) for stage in stages},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--datasets', nargs='*',
+                        help='Oracle JSON files (default: every file in oracle-json-files/)')
+    parser.add_argument('--scale', type=int, nargs='*', default=[4],
+                        help='Synthetic dataset sizes as multiples of the bundled records')
+    parser.add_argument('--extra-characters', type=int, default=2,
+                        help='Copies of each character added to synthetic records')
+    parser.add_argument('--max-probes', type=int, help='Probes run through the stub ADM per dataset')
+    parser.add_argument('--prompt-latency', type=float, default=0.0,
+                        help='Stub ADM seconds per get_dialog_texts call')
+    parser.add_argument('--choose-latency', type=float, default=0.0,
+                        help='Stub ADM seconds per top_level_choose_action call')
+    parser.add_argument('--output', help='JSON output file (default: stdout)')
+    args = parser.parse_args()
+
+    paths = args.datasets or sorted(
+        os.path.join(DATASET_DIR, name) for name in os.listdir(DATASET_DIR) if name.endswith('.json'))
+    adm = FakeADM('stub', prompt_latency=args.prompt_latency, choose_latency=args.choose_latency)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for path in paths:
+            # Bundled files are copied so the benchmark's catalogs don't
+            # replace the ones next to the dataset
+            with open(path) as f:
+                records = json.load(f)
+            copy_path = os.path.join(tmp_dir, os.path.basename(path))
+            with open(copy_path, 'w') as f:
+                json.dump(records, f)
+            results.append(bench_dataset(copy_path, adm, args.max_probes))
+
+            for scale in args.scale:
+                synthetic_path = os.path.join(
+                    tmp_dir, f"{os.path.splitext(os.path.basename(path))[0]}_x{scale}.json")
+                with open(synthetic_path, 'w') as f:
+                    json.dump(synthetic_records(records, scale, args.extra_characters), f)
+                results.append(bench_dataset(synthetic_path, adm, args.max_probes))
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'stub_adm': {'prompt_latency': args.prompt_latency, 'choose_latency': args.choose_latency},
+        'extra_characters': args.extra_characters,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+'''
+Tokens per second of single-prompt structured generation with and without
+a speculative decoding draft model, over probes of an oracle dataset.
+Checks that both runs choose the same action with the same justification.
+Needs the backbone and draft weights (and usually a GPU).
+
+    python -m benchmarks.bench_speculative --llm-backbone meta-llama/Meta-Llama-3-8B-Instruct \
+        --draft-model meta-llama/Llama-3.2-1B-Instruct --probes 8
+'''
+import argparse
+import copy
+import os
+
+from adm_generation import KDMA_DESCRIPTIONS_MAP, GenerationRun, choose_actions_batched
+from metrics import Trace, use_traces
+from model_pool import MODEL_POOL, PRECISIONS, load_adm_config
+from oracle_loader import OracleDataset
+from prefix_cache import get_prefix_cache
+from probe_index import hydrate_probe
+
+
+def dataset_probes(path, num_probes):
+    dataset = OracleDataset(path)
+    entries = [entry for scenario_id in dataset.scenario_ids for entry in dataset.probes(scenario_id)]
+    return [hydrate_probe(dataset.read(entry), entry['probe_id']) for entry in entries[:num_probes]]
+
+
+def generate(instance, probe, demo_kwargs):
+    prompts, _ = instance.get_dialog_texts(
+        scenario_state=probe.state,
+        available_actions=probe.actions_filtered,
+        alignment_target=None,
+        kdma_descriptions_map=KDMA_DESCRIPTIONS_MAP,
+        demo_kwargs=demo_kwargs)
+    run = GenerationRun(instance, prompts[0], probe.state, probe.actions_filtered)
+
+    # Each run encodes the whole prompt, so neither mode gets a head start
+    # from the other's cached prefix
+    get_prefix_cache(instance.model.model).clear()
+    trace = Trace()
+    with use_traces(trace):
+        action, = choose_actions_batched([run], demo_kwargs)
+    return action, trace
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--llm-backbone', default='meta-llama/Meta-Llama-3-8B-Instruct')
+    parser.add_argument('--draft-model', default='meta-llama/Llama-3.2-1B-Instruct',
+                        help='Draft model sharing the backbone tokenizer')
+    parser.add_argument('--adm', default='outlines_transformers_structured')
+    parser.add_argument('--dataset', default=os.path.join('oracle-json-files', 'mre_input_output.json'))
+    parser.add_argument('--probes', type=int, default=8)
+    parser.add_argument('--num-assistant-tokens', type=int, default=5)
+    parser.add_argument('--precision', choices=list(PRECISIONS), default=None)
+    parser.add_argument('--device', default=None)
+    args = parser.parse_args()
+
+    adm_config = load_adm_config(args.adm, False, args.llm_backbone, args.precision, args.device)
+    adm_config.speculative_decoding = {
+        'num_assistant_tokens': args.num_assistant_tokens,
+        'draft_models': {args.llm_backbone: args.draft_model},
+    }
+    speculative = MODEL_POOL.get(adm_config).instance
+    greedy = copy.copy(speculative)
+    greedy.draft_model = None
+    demo_kwargs = adm_config.demo_kwargs
+
+    print(f"{'probe':<40} {'tokens':>6} {'greedy tok/s':>12} {'draft tok/s':>11} {'speedup':>7} {'same':>5}")
+    totals = {'greedy': [0, 0.0], 'draft': [0, 0.0]}
+    mismatches = 0
+    for probe in dataset_probes(args.dataset, args.probes):
+        greedy_action, greedy_trace = generate(greedy, probe, demo_kwargs)
+        draft_action, draft_trace = generate(speculative, probe, demo_kwargs)
+        same = (greedy_action.action_id == draft_action.action_id and
+                greedy_action.justification == draft_action.justification)
+        mismatches += not same
+
+        rates = []
+        for mode, trace in (('greedy', greedy_trace), ('draft', draft_trace)):
+            totals[mode][0] += trace.tokens
+            totals[mode][1] += trace.generation_seconds
+            rates.append(trace.tokens / max(trace.generation_seconds, 1e-9))
+        print(f"{probe.probe_id[:40]:<40} {greedy_trace.tokens:>6} {rates[0]:>12.1f} {rates[1]:>11.1f} "
+              f"{rates[1] / max(rates[0], 1e-9):>6.2f}x {'yes' if same else 'NO':>5}")
+
+    greedy_rate, draft_rate = (tokens / max(seconds, 1e-9) for tokens, seconds in totals.values())
+    print(f"{'total':<40} {totals['greedy'][0]:>6} {greedy_rate:>12.1f} {draft_rate:>11.1f} "
+          f"{draft_rate / max(greedy_rate, 1e-9):>6.2f}x {mismatches:>5}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+'''
+Checks that the app's direct generation path (choose_actions_batched, used
+for greedy RUN MODEL, batch_eval and precompute) chooses the same action
+with the same justification as the ADM's own top_level_choose_action, over
+the probes of the bundled oracle datasets. Exits non-zero on any mismatch.
+Needs the backbone weights (and usually a GPU).
+
+    python -m benchmarks.check_generation_parity --llm-backbone mistralai/Mistral-7B-Instruct-v0.2
+    python -m benchmarks.check_generation_parity --aligned --alignment-target maximization_high
+'''
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+from adm_generation import (
+    KDMA_DESCRIPTIONS_MAP,
+    GenerationRun,
+    can_generate_directly,
+    choose_actions_batched,
+)
+from alignment_targets import load_alignment_target
+from benchmarks.bench_speculative import dataset_probes
+from model_pool import MODEL_POOL, PRECISIONS, load_adm_config
+from prefix_cache import get_prefix_cache
+
+DATASET_DIR = 'oracle-json-files'
+
+
+def adm_choice(instance, probe, alignment_target, demo_kwargs):
+    start = time.perf_counter()
+    action, _ = instance.top_level_choose_action(
+        scenario_state=probe.state,
+        available_actions=probe.actions_filtered,
+        alignment_target=alignment_target,
+        kdma_descriptions_map=KDMA_DESCRIPTIONS_MAP,
+        tokenizer_kwargs={'truncation': False},
+        demo_kwargs=demo_kwargs)
+    return action, time.perf_counter() - start
+
+
+def direct_choice(instance, probe, alignment_target, demo_kwargs):
+    start = time.perf_counter()
+    prompts, _ = instance.get_dialog_texts(
+        scenario_state=probe.state,
+        available_actions=probe.actions_filtered,
+        alignment_target=alignment_target,
+        kdma_descriptions_map=KDMA_DESCRIPTIONS_MAP,
+        demo_kwargs=demo_kwargs)
+    # Every probe encodes its whole prompt, as the ADM does
+    get_prefix_cache(instance.model.model).clear()
+    action, = choose_actions_batched(
+        [GenerationRun(instance, prompts[0], probe.state, probe.actions_filtered)], demo_kwargs)
+    return action, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--llm-backbone', default='mistralai/Mistral-7B-Instruct-v0.2')
+    parser.add_argument('--adm', default='outlines_transformers_structured')
+    parser.add_argument('--aligned', action='store_true')
+    parser.add_argument('--alignment-target', default=None,
+                        help='Alignment target config name, for --aligned')
+    parser.add_argument('--datasets', nargs='*',
+                        help='Oracle JSON files (default: every file in oracle-json-files/)')
+    parser.add_argument('--probes', type=int, default=None, help='Most probes checked per dataset')
+    parser.add_argument('--precision', choices=list(PRECISIONS), default=None)
+    parser.add_argument('--device', default=None)
+    args = parser.parse_args()
+    if args.aligned and args.alignment_target is None:
+        parser.error('--aligned needs an --alignment-target')
+
+    # Same torch determinism as the app
+    os.environ["CUBLAS_WORKSPACE_CONFIG"] = ":4096:8"
+    torch.use_deterministic_algorithms(True)
+
+    adm_config = load_adm_config(args.adm, args.aligned, args.llm_backbone, args.precision, args.device)
+    instance = MODEL_POOL.get(adm_config).instance
+    if not can_generate_directly(instance):
+        print(f"{args.adm} doesn't decode greedily, so the app always runs it through the ADM")
+        return
+    instance.system_ui_prompt = None
+    alignment_target = load_alignment_target(args.alignment_target) if args.aligned else None
+    demo_kwargs = adm_config.demo_kwargs
+
+    paths = args.datasets or sorted(
+        os.path.join(DATASET_DIR, name) for name in os.listdir(DATASET_DIR) if name.endswith('.json'))
+    print(f"{'probe':<40} {'adm s':>7} {'direct s':>8} {'action':>6} {'same':>5}")
+    checked = mismatches = 0
+    for path in paths:
+        for probe in dataset_probes(path, args.probes):
+            adm_action, adm_seconds = adm_choice(instance, probe, alignment_target, demo_kwargs)
+            direct_action, direct_seconds = direct_choice(instance, probe, alignment_target, demo_kwargs)
+            same_action = adm_action.action_id == direct_action.action_id
+            same = same_action and adm_action.justification == direct_action.justification
+            checked += 1
+            mismatches += not same
+            print(f"{probe.probe_id[:40]:<40} {adm_seconds:>7.2f} {direct_seconds:>8.2f} "
+                  f"{'yes' if same_action else 'NO':>6} {'yes' if same else 'NO':>5}")
+
+    print(f"{mismatches} of {checked} probes differ from the ADM's output")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+'''
+Load test of the per-model request queue with a FakeADM: simulated users
+submit RUN MODEL requests concurrently, with and without micro-batching.
+Reports throughput, latency percentiles, rejections and batch sizes.
+
+    python -m benchmarks.load_test_queue --users 16 --requests 4
+'''
+import argparse
+import statistics
+import threading
+import time
+from types import SimpleNamespace
+
+from fake_adm import FakeADM
+from request_queue import Job, ModelQueue, QueueFull
+
+
+def synthetic_run(fake, user, request):
+    state = SimpleNamespace(characters=[], unstructured=f"Situation {user}.{request}")
+    actions = [SimpleNamespace(action_id=f"action_{i}", unstructured=f"Choice {i}", justification=None)
+               for i in range(4)]
+    prompts, _ = fake.get_dialog_texts(state, actions, None)
+    return SimpleNamespace(instance=fake, prompt=prompts[0], scenario_state=state, available_actions=actions)
+
+
+def load_test(fake, users, requests, concurrency, max_depth, max_batch, think_time):
+    batch_sizes = []
+
+    def run_batch(runs):
+        batch_sizes.append(len(runs))
+        return fake.choose_actions_batched(runs)
+
+    queue = ModelQueue(run_batch, concurrency=concurrency, max_depth=max_depth, max_batch=max_batch)
+    latencies = []
+    rejected = []
+    lock = threading.Lock()
+
+    def user_session(user):
+        for request in range(requests):
+            run = synthetic_run(fake, user, request)
+
+            def generate(on_text, stop_event, run=run):
+                batch_sizes.append(1)
+                action, _ = fake.top_level_choose_action(run.scenario_state, run.available_actions, None)
+                return action.action_id
+
+            job = Job(generate, run=run, finish=lambda action: action.action_id)
+            start = time.perf_counter()
+            try:
+                queue.submit(job)
+            except QueueFull:
+                with lock:
+                    rejected.append(time.perf_counter() - start)
+            else:
+                job.wait()
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+            time.sleep(think_time)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=user_session, args=(user,)) for user in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'completed': len(latencies),
+        'rejected': len(rejected),
+        'throughput': len(latencies) / elapsed,
+        'p50': statistics.median(latencies) if latencies else 0.0,
+        'p95': latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0.0,
+        'max_reject_ms': max(rejected, default=0.0) * 1000,
+        'mean_batch': statistics.mean(batch_sizes) if batch_sizes else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=4, help='Requests per user')
+    parser.add_argument('--latency', type=float, default=0.2, help='FakeADM seconds per generation')
+    parser.add_argument('--batch-latency', type=float, default=0.02,
+                        help='FakeADM added seconds per extra prompt in a batch')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--max-depth', type=int, default=8)
+    parser.add_argument('--max-batch', type=int, default=8)
+    parser.add_argument('--think-time', type=float, default=0.0,
+                        help='Seconds each user waits between requests')
+    args = parser.parse_args()
+
+    fake = FakeADM(choose_latency=args.latency, batch_latency=args.batch_latency)
+    print(f"{'max batch':>9} {'completed':>9} {'rejected':>8} {'req/s':>7} "
+          f"{'p50 s':>6} {'p95 s':>6} {'reject ms':>9} {'mean batch':>10}")
+    for max_batch in sorted({1, args.max_batch}):
+        result = load_test(fake, args.users, args.requests, args.concurrency,
+                           args.max_depth, max_batch, args.think_time)
+        print(f"{max_batch:>9} {result['completed']:>9} {result['rejected']:>8} "
+              f"{result['throughput']:>7.2f} {result['p50']:>6.2f} {result['p95']:>6.2f} "
+              f"{result['max_reject_ms']:>9.2f} {result['mean_batch']:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,2 @@
+# The app's modules live at the repository root, which pytest puts on
+# sys.path for this conftest
@@ -0,0 +1,51 @@
+import os
+
+from oracle_loader import OracleDataset, file_version
+from probe_index import clear_dataset, get_probe, hydrate_probe, index_probe
+
+DATASET_DIR = 'oracle-json-files'
+# Write the catalog next to each dataset file
+CACHE_DATASET_CATALOG = True
+
+# Datasets loaded on the server keyed by file name. The browser-side
+# dataset-store only holds a handle ({'dataset': ..., 'version': ...}) so
+# callback payloads don't grow with the dataset.
+DATASETS = {}
+
+
+def load_dataset(dataset):
+    path = os.path.join(DATASET_DIR, dataset)
+    version = file_version(path)
+
+    if dataset not in DATASETS or DATASETS[dataset].version != version:
+        # Only the catalog is read up front; records are decoded and
+        # hydrated once a probe is chosen
+        clear_dataset(dataset)
+        DATASETS[dataset] = OracleDataset(path, cache=CACHE_DATASET_CATALOG)
+
+    return {'dataset': dataset, 'version': DATASETS[dataset].version}
+
+
+def get_dataset(handle):
+    if handle['dataset'] not in DATASETS:
+        load_dataset(handle['dataset'])
+    return DATASETS[handle['dataset']]
+
+
+def get_scenario_ids(handle):
+    return get_dataset(handle).scenario_ids
+
+
+def get_scenario_probes(handle, scenario_id):
+    # Catalog entries: probe ID, record offsets, character and action counts
+    return get_dataset(handle).probes(scenario_id)
+
+
+def get_scenario_probe(handle, scenario_id, probe_id):
+    dataset = handle['dataset']
+    probe = get_probe(dataset, scenario_id, probe_id)
+    if probe is None:
+        record = get_dataset(handle).record(scenario_id, probe_id)
+        probe = hydrate_probe(record, probe_id)
+        index_probe(dataset, scenario_id, probe)
+    return probe
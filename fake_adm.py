@@ -0,0 +1,99 @@
+import copy
+import hashlib
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+DEFAULT_SYSTEM_PROMPT = 'You are an assistant specialized in answering multiple-choice questions related to medical triage.'
+
+
+class FakeModel:
+    '''
+    Stands in for a loaded backbone, so panels sharing a fake backbone share
+    its request queue like they would a real one
+    '''
+    def __init__(self, model_name):
+        self.model_name = model_name
+
+
+class FakeADM:
+    '''
+    Deterministic ADM with fixed latencies and no model weights, for load
+    testing the UI and request queue on CPU. Builds prompts in the same
+    section layout as the real ADM's and picks an action from a hash of the
+    prompt and alignment target.
+    '''
+    def __init__(self, model_name='fake', prompt_latency=0.0, choose_latency=0.5,
+                 batch_latency=0.1, model=None, baseline=False):
+        self.model_name = model_name
+        self.prompt_latency = prompt_latency
+        self.choose_latency = choose_latency
+        # Added latency per extra prompt in a batched call
+        self.batch_latency = batch_latency
+        self.model = model if model is not None else FakeModel(model_name)
+        # Like the real baseline ADM, ignores the alignment target
+        self.baseline = baseline
+        self.system_ui_prompt = None
+
+    def _prompt(self, scenario_state, available_actions):
+        system_prompt = self.system_ui_prompt or DEFAULT_SYSTEM_PROMPT
+        characters = []
+        for character in scenario_state.characters:
+            characters.append(f"{character.name}: {character.unstructured}")
+            characters.append(f"{character.name}'s intent: {character.intent}")
+        choices = [f"({i}) {action.unstructured}" for i, action in enumerate(available_actions)]
+        return '\n\n'.join([
+            f"<s>[INST]{system_prompt}",
+            '\n'.join(['CHARACTERS:', *characters]),
+            '\n'.join(['SITUATION:', str(scenario_state.unstructured)]),
+            '\n'.join(['CHOICES:', *choices]),
+        ]) + ' [/INST]'
+
+    def get_dialog_texts(self, scenario_state, available_actions, alignment_target, **kwargs):
+        time.sleep(self.prompt_latency)
+        prompt = self._prompt(scenario_state, available_actions)
+        return [prompt], [[{'role': 'user', 'content': prompt}]]
+
+    def _choose(self, prompt, available_actions, alignment_target):
+        if self.baseline:
+            alignment_target = None
+        key = json.dumps([prompt, alignment_target], sort_keys=True, default=str)
+        index = int(hashlib.sha256(key.encode()).hexdigest(), 16) % len(available_actions)
+        action = copy.deepcopy(available_actions[index])
+        action.justification = f"Fake justification for choice ({index})."
+        return action
+
+    def top_level_choose_action(self, scenario_state, available_actions, alignment_target, **kwargs):
+        prompts, dialogs = self.get_dialog_texts(scenario_state, available_actions, alignment_target)
+        time.sleep(self.choose_latency)
+        return self._choose(prompts[0], available_actions, alignment_target), dialogs[0]
+
+    def choose_actions_batched(self, runs):
+        # One call for a batch of GenerationRuns, mimicking a batched
+        # generation that costs more than one prompt but less than several
+        time.sleep(self.choose_latency + self.batch_latency * (len(runs) - 1))
+        return [self._choose(run.prompt, run.available_actions, None) for run in runs]
+
+
+# Fake ADMs per backbone, shared between panels like the model pool's
+_FAKE_ADMS = {}
+_LOCK = threading.Lock()
+
+
+def load_fake_adm(adm_config, choose_latency):
+    '''
+    Panel ADM (instance, config) backed by a FakeADM. The config's instance
+    is replaced so fake responses are cached apart from real ones.
+    '''
+    adm_config = copy.deepcopy(adm_config)
+    model_name = adm_config.instance.model_name
+    baseline = bool(adm_config.instance.get('baseline', False))
+    adm_config.instance = {'_target_': 'fake_adm.FakeADM', 'model_name': model_name,
+                           'choose_latency': choose_latency, 'baseline': baseline}
+    with _LOCK:
+        if model_name not in _FAKE_ADMS:
+            _FAKE_ADMS[model_name] = FakeADM(model_name, choose_latency=choose_latency)
+        instance = copy.copy(_FAKE_ADMS[model_name])
+    instance.baseline = baseline
+    return SimpleNamespace(instance=instance, config=adm_config)
@@ -0,0 +1,92 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import pickle
+import threading
+
+import outlines
+from outlines.fsm.guide import RegexGuide
+from outlines.fsm.json_schema import build_regex_from_schema
+from outlines.processors import GuideLogitsProcessor
+
+from metrics import span
+
+# Compiled guides are pickled here so they survive server restarts
+GUIDE_CACHE_DIR = os.environ.get('ALIGN_DEMO_GUIDE_CACHE', '.cache/guides')
+MAX_GUIDES_IN_MEMORY = 64
+
+_GUIDES = OrderedDict()
+_KEY_LOCKS = {}
+_LOCK = threading.Lock()
+
+
+def _guide_key(tokenizer, schema, whitespace_pattern):
+    hf_tokenizer = getattr(tokenizer, 'tokenizer', tokenizer)
+    key = {
+        'tokenizer': hf_tokenizer.name_or_path,
+        'vocab_size': len(hf_tokenizer),
+        'schema': schema,
+        'whitespace_pattern': whitespace_pattern,
+        'outlines': getattr(outlines, '__version__', None),
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def _load_guide(path):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        return None
+
+
+def _save_guide(path, guide):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", 'wb') as f:
+            pickle.dump(guide, f)
+        os.replace(f"{path}.tmp", path)
+    except OSError:
+        pass
+
+
+def get_guide(tokenizer, schema, whitespace_pattern):
+    '''
+    Compiled regex guide for a JSON schema, shared by every panel using the
+    same tokenizer. Compiled guides are kept in memory and on disk.
+    '''
+    key = _guide_key(tokenizer, schema, whitespace_pattern)
+    with _LOCK:
+        if key in _GUIDES:
+            _GUIDES.move_to_end(key)
+            return _GUIDES[key]
+
+        key_lock = _KEY_LOCKS.setdefault(key, threading.Lock())
+
+    # A run waiting on a guide that's still being precompiled picks up
+    # that compilation instead of starting another
+    with key_lock:
+        with _LOCK:
+            if key in _GUIDES:
+                return _GUIDES[key]
+
+        path = os.path.join(GUIDE_CACHE_DIR, f"{key}.pkl")
+        guide = _load_guide(path)
+        if guide is None:
+            with span('guide_compile'):
+                guide = RegexGuide(build_regex_from_schema(schema, whitespace_pattern), tokenizer)
+            _save_guide(path, guide)
+
+        with _LOCK:
+            _GUIDES[key] = guide
+            _KEY_LOCKS.pop(key, None)
+            while len(_GUIDES) > MAX_GUIDES_IN_MEMORY:
+                _GUIDES.popitem(last=False)
+    return guide
+
+
+def json_logits_processor(tokenizer, schema, whitespace_pattern):
+    # Guides are stateless and can be shared; the processor tracks the
+    # per-sequence guide state so a new one is needed for each generation
+    return GuideLogitsProcessor(tokenizer=tokenizer, guide=get_guide(tokenizer, schema, whitespace_pattern))
@@ -0,0 +1,174 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import time
+
+# Upper bounds (seconds) of the stage duration histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+# Panels whose latest trace is kept for the UI timing view
+MAX_PANEL_TRACES = 256
+
+_LOCK = threading.Lock()
+_CURRENT = threading.local()
+
+
+class Histogram:
+    def __init__(self):
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+# Stage durations keyed by stage name, Dash request durations keyed by
+# callback output, and generation totals keyed by model name
+STAGE_SECONDS = {}
+DASH_REQUEST_SECONDS = {}
+GENERATED_TOKENS = {}
+GENERATION_SECONDS = {}
+LAST_TOKENS_PER_SECOND = {}
+
+
+class Trace:
+    '''
+    Timings of one request (a panel's LOAD SYSTEM PROMPT or RUN MODEL), in
+    the order its stages finished
+    '''
+    def __init__(self):
+        self.spans = []
+        self.tokens = 0
+        self.generation_seconds = 0.0
+
+    def add(self, stage, seconds):
+        self.spans.append((stage, seconds))
+
+    def text(self):
+        lines = [f"{stage}: {seconds * 1000:.1f} ms" for stage, seconds in self.spans]
+        if self.tokens:
+            lines.append(f"tokens: {self.tokens} "
+                         f"({self.tokens / max(self.generation_seconds, 1e-9):.1f} tokens/s)")
+        return '\n'.join(lines)
+
+
+def current_traces():
+    return getattr(_CURRENT, 'traces', [])
+
+
+@contextmanager
+def use_traces(*traces):
+    '''
+    Attribute spans and generated tokens recorded on this thread to traces,
+    e.g. while a queue worker runs the jobs they belong to
+    '''
+    previous = current_traces()
+    # Jobs of one request (e.g. a sweep) batched together share a trace
+    _CURRENT.traces = list({id(trace): trace for trace in traces if trace is not None}.values())
+    try:
+        yield
+    finally:
+        _CURRENT.traces = previous
+
+
+def observe(stage, seconds, traces=None):
+    with _LOCK:
+        STAGE_SECONDS.setdefault(stage, Histogram()).observe(seconds)
+    for trace in current_traces() if traces is None else traces:
+        trace.add(stage, seconds)
+
+
+@contextmanager
+def span(stage, trace=None):
+    '''Time a stage into the stage histogram and the current traces'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start, None if trace is None else [trace])
+
+
+def record_generation(model_name, tokens, seconds):
+    with _LOCK:
+        GENERATED_TOKENS[model_name] = GENERATED_TOKENS.get(model_name, 0) + tokens
+        GENERATION_SECONDS[model_name] = GENERATION_SECONDS.get(model_name, 0.0) + seconds
+        LAST_TOKENS_PER_SECOND[model_name] = tokens / max(seconds, 1e-9)
+    for trace in current_traces():
+        trace.tokens += tokens
+        trace.generation_seconds += seconds
+
+
+# Latest trace per panel key
+PANEL_TRACES = OrderedDict()
+
+
+def set_panel_trace(panel, trace):
+    with _LOCK:
+        PANEL_TRACES[panel] = trace
+        PANEL_TRACES.move_to_end(panel)
+        while len(PANEL_TRACES) > MAX_PANEL_TRACES:
+            PANEL_TRACES.popitem(last=False)
+
+
+def get_panel_trace(panel):
+    return PANEL_TRACES.get(panel)
+
+
+def _label(value):
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return f'"{value}"'
+
+
+def _histogram_lines(name, label, histograms):
+    lines = [f"# TYPE {name} histogram"]
+    for key, histogram in sorted(histograms.items()):
+        for bound, count in zip(BUCKETS, histogram.bucket_counts):
+            lines.append(f'{name}_bucket{{{label}={_label(key)},le="{bound}"}} {count}')
+        lines.append(f'{name}_bucket{{{label}={_label(key)},le="+Inf"}} {histogram.count}')
+        lines.append(f"{name}_sum{{{label}={_label(key)}}} {histogram.sum}")
+        lines.append(f"{name}_count{{{label}={_label(key)}}} {histogram.count}")
+    return lines
+
+
+def render():
+    '''Metrics in the Prometheus text exposition format'''
+    with _LOCK:
+        lines = _histogram_lines('align_demo_stage_seconds', 'stage', STAGE_SECONDS)
+        lines += _histogram_lines('align_demo_dash_request_seconds', 'output', DASH_REQUEST_SECONDS)
+        for name, kind, values in (
+                ('align_demo_generated_tokens_total', 'counter', GENERATED_TOKENS),
+                ('align_demo_generation_seconds_total', 'counter', GENERATION_SECONDS),
+                ('align_demo_tokens_per_second', 'gauge', LAST_TOKENS_PER_SECOND)):
+            lines.append(f"# TYPE {name} {kind}")
+            lines += [f"{name}{{model={_label(model)}}} {value}" for model, value in sorted(values.items())]
+    return '\n'.join(lines) + '\n'
+
+
+def register_metrics(server):
+    '''
+    Add a /metrics route to the Dash app's Flask server and time every
+    callback request, including Dash's serialization of the response
+    '''
+    from flask import Response, g, request
+
+    @server.before_request
+    def _start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @server.after_request
+    def _record_request(response):
+        if request.path.endswith('/_dash-update-component') and 'metrics_start' in g:
+            payload = request.get_json(silent=True) or {}
+            output = payload.get('output', 'unknown')
+            with _LOCK:
+                DASH_REQUEST_SECONDS.setdefault(output, Histogram()).observe(
+                    time.perf_counter() - g.metrics_start)
+        return response
+
+    @server.route('/metrics')
+    def _metrics():
+        return Response(render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,96 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from fake_adm import load_fake_adm
+from metrics import observe
+from worker_pool import WORKER_DEVICES, get_worker_pool
+
+# Loads run off the Dash worker threads, one at a time so two multi-GB loads
+# don't compete for memory; a second panel's load queues behind the first
+_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='adm-loader')
+_LOCK = threading.Lock()
+
+# Set to a latency in seconds to load fake ADMs instead of real ones, for
+# load testing the UI without a GPU
+FAKE_ADM_LATENCY = os.environ.get('ALIGN_DEMO_FAKE_ADM')
+
+# Latest load job per panel key (see session_registry.panel_key):
+# {'status': ..., 'progress': [...]}
+LOAD_JOBS = {}
+# Loaded ADM per panel key
+PANEL_ADMS = {}
+
+
+def submit_load(panel, llm_backbone, adm_type, aligned, precision=None, device=None):
+    '''
+    Queue a background load for a panel. Returns False without starting
+    another load if one is already queued or running for that panel.
+    precision and device override the ADM config's (see
+    model_pool.load_adm_config).
+    '''
+    with _LOCK:
+        job = LOAD_JOBS.get(panel)
+        if job is not None and job['status'] in ('queued', 'loading'):
+            return False
+        job = {'status': 'queued', 'progress': [f"Queued {llm_backbone}"]}
+        LOAD_JOBS[panel] = job
+
+    _EXECUTOR.submit(_load, panel, job, llm_backbone, adm_type, aligned, precision, device)
+    return True
+
+
+def _load(panel, job, llm_backbone, adm_type, aligned, precision, device):
+    job['status'] = 'loading'
+    start = time.perf_counter()
+    try:
+        # torch, hydra and the model libraries are only imported once the
+        # first model is loaded, so the UI starts without them
+        from model_pool import MODEL_POOL, load_adm_config
+
+        adm_config = load_adm_config(adm_type, aligned, llm_backbone, precision, device)
+        job['progress'].append("Config parsed")
+        if FAKE_ADM_LATENCY:
+            PANEL_ADMS[panel] = load_fake_adm(adm_config, float(FAKE_ADM_LATENCY))
+        elif WORKER_DEVICES:
+            # Workers own their devices, so only the precision carries over
+            job['progress'].append(f"Starting ADM workers on {', '.join(WORKER_DEVICES)}")
+            worker_pool = get_worker_pool(llm_backbone, adm_type, precision)
+            worker_pool.wait_ready()
+            PANEL_ADMS[panel] = SimpleNamespace(instance=worker_pool.adm_instance(aligned), config=adm_config)
+        else:
+            PANEL_ADMS[panel] = MODEL_POOL.get(adm_config, progress=job['progress'].append)
+        if not FAKE_ADM_LATENCY:
+            # The UI inputs the ADM was loaded with, which key precomputed
+            # results (see precomputed_results.ResultKey)
+            PANEL_ADMS[panel].load_inputs = {
+                'llm_backbone': llm_backbone,
+                'adm_type': adm_type,
+                'aligned': bool(aligned),
+                'precision': precision or adm_config.get('precision'),
+            }
+    except Exception as e:
+        job['progress'].append(f"Load failed: {e}")
+        job['status'] = 'error'
+    else:
+        seconds = time.perf_counter() - start
+        observe('model_load', seconds, [])
+        job['progress'].append(f"Ready ({seconds:.1f} s)")
+        job['status'] = 'done'
+
+
+def get_load_status(panel):
+    return LOAD_JOBS.get(panel)
+
+
+def get_panel_adm(panel):
+    return PANEL_ADMS.get(panel)
+
+
+def drop_session(session_id):
+    with _LOCK:
+        for registry in (LOAD_JOBS, PANEL_ADMS):
+            for panel in [p for p in registry if p[0] == session_id]:
+                del registry[panel]
@@ -0,0 +1,231 @@
+import copy
+import gc
+import json
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import hydra
+from omegaconf import OmegaConf
+import torch
+
+# Torch determinism for reproducibility, set before the first model loads
+os.environ["CUBLAS_WORKSPACE_CONFIG"] = ":4096:8"
+torch.use_deterministic_algorithms(True)
+
+ADM_CONFIG_DIR = 'configs/hydra/adm'
+# Memory budget for loaded backbones; least recently used backbones are
+# evicted once the pool grows past it
+MODEL_POOL_BUDGET_GB = float(os.environ.get('ALIGN_DEMO_MODEL_POOL_GB', 64))
+
+# ADM instance attributes that differ between panels sharing one backbone
+# (e.g. baseline vs aligned) and so aren't part of the pool key
+PANEL_KEYS = ('baseline', 'mode', 'sampler')
+
+# from_pretrained kwargs per weight precision. int8 and 4bit quantize with
+# bitsandbytes, which needs a GPU; with half precision or lower both
+# backbones fit on one GPU.
+PRECISIONS = {
+    'full': {'torch_dtype': 'float32'},
+    'half': {'torch_dtype': 'float16'},
+    'int8': {'quantization_config': {'_target_': 'transformers.BitsAndBytesConfig',
+                                     'load_in_8bit': True}},
+    '4bit': {'quantization_config': {'_target_': 'transformers.BitsAndBytesConfig',
+                                     'load_in_4bit': True,
+                                     'bnb_4bit_quant_type': 'nf4',
+                                     'bnb_4bit_compute_dtype': 'float16'}},
+}
+QUANTIZED_PRECISIONS = ('int8', '4bit')
+
+
+def load_adm_config(adm_type, aligned, llm_backbone, precision=None, device=None):
+    '''
+    ADM config for a backbone. precision (a PRECISIONS key) and device
+    (e.g. 'auto', 'cpu', 'cuda:1') override the config's own `precision`
+    and `device`; when neither sets them the ADM's defaults apply.
+    '''
+    variant = 'aligned' if aligned else 'baseline'
+    adm_config = OmegaConf.load(os.path.join(ADM_CONFIG_DIR, f"{adm_type}_{variant}.yaml"))
+    adm_config.instance.model_name = llm_backbone
+
+    precision = precision or adm_config.get('precision')
+    device = device or adm_config.get('device')
+    if device is not None:
+        adm_config.instance.device = device
+    if precision is not None:
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision {precision!r}, expected one of {', '.join(PRECISIONS)}")
+        if precision in QUANTIZED_PRECISIONS and str(adm_config.instance.get('device')) == 'cpu':
+            raise ValueError(f"{precision} weights need a GPU, use full or half precision on CPU")
+        adm_config.instance.model_kwargs = OmegaConf.merge(
+            adm_config.instance.get('model_kwargs') or {}, PRECISIONS[precision])
+    return adm_config
+
+
+def _pool_key(instance_config):
+    weight_config = {k: v for k, v in OmegaConf.to_container(instance_config).items()
+                     if k not in PANEL_KEYS}
+    return json.dumps(weight_config, sort_keys=True)
+
+
+def _torch_model(instance):
+    return getattr(instance.model, 'model', instance.model)
+
+
+def _model_size_bytes(instance):
+    models = [_torch_model(instance)]
+    if getattr(instance, 'draft_model', None) is not None:
+        models.append(instance.draft_model)
+    return sum(p.numel() * p.element_size() for model in models for p in model.parameters())
+
+
+def _estimate_params(model_name):
+    # Parameter count from the model's config, built on the meta device so
+    # nothing is allocated or downloaded besides the config
+    from accelerate import init_empty_weights
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(AutoConfig.from_pretrained(model_name))
+    return sum(p.numel() for p in model.parameters())
+
+
+def _bytes_per_param(model_kwargs):
+    quantization = model_kwargs.get('quantization_config') or {}
+    if quantization.get('load_in_4bit'):
+        return 0.5
+    if quantization.get('load_in_8bit'):
+        return 1
+    dtype = model_kwargs.get('torch_dtype')
+    if isinstance(dtype, str) and dtype != 'auto':
+        return getattr(torch, dtype).itemsize
+    return 4
+
+
+def estimate_size_bytes(adm_config):
+    '''
+    Memory the config's backbone (and draft model) will take once loaded,
+    estimated before loading it, or None if it can't be estimated
+    '''
+    model_kwargs = OmegaConf.to_container(adm_config.instance.get('model_kwargs') or {})
+    speculative = adm_config.get('speculative_decoding') or {}
+    model_names = [adm_config.instance.model_name]
+    draft_name = (speculative.get('draft_models') or {}).get(adm_config.instance.model_name)
+    if draft_name is not None:
+        model_names.append(draft_name)
+    try:
+        num_params = sum(_estimate_params(name) for name in model_names)
+    except Exception:
+        return None
+    return int(num_params * _bytes_per_param(model_kwargs))
+
+
+def _model_devices(instance):
+    return sorted({str(p.device) for p in _torch_model(instance).parameters()})
+
+
+def load_draft_model(adm_config, instance):
+    '''
+    Draft model the config's `speculative_decoding` section lists for the
+    instance's backbone, loaded next to the backbone with its dtype, or
+    None when there isn't one
+    '''
+    speculative = adm_config.get('speculative_decoding') or {}
+    draft_name = (speculative.get('draft_models') or {}).get(adm_config.instance.model_name)
+    if draft_name is None:
+        return None
+
+    from transformers import AutoModelForCausalLM
+
+    model = _torch_model(instance)
+    draft_model = AutoModelForCausalLM.from_pretrained(draft_name, torch_dtype=model.dtype).to(model.device)
+    draft_model.generation_config.num_assistant_tokens = speculative.get('num_assistant_tokens', 5)
+    return draft_model
+
+
+class ModelPool:
+    '''
+    Process-wide pool of loaded ADM backbones keyed by model name and
+    weight-related config. Panels get shallow copies of the pooled ADM
+    instance so baseline and aligned ADMs share one set of weights.
+
+    Before a backbone loads, least recently used backbones no panel holds
+    are evicted to make room for its estimated size. Backbones panels still
+    hold are never evicted, since that frees no memory.
+    '''
+    def __init__(self, budget_gb=MODEL_POOL_BUDGET_GB):
+        self.budget_bytes = int(budget_gb * 1024**3)
+        self._entries = OrderedDict()
+        # Every loaded base instance still alive, pooled or not, so one
+        # still in memory is reused instead of loaded again
+        self._live = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def get(self, adm_config, progress=None):
+        if progress is None:
+            progress = lambda message: None  # noqa: E731
+
+        key = _pool_key(adm_config.instance)
+        model_name = adm_config.instance.model_name
+        with self._lock:
+            entry = self._entries.get(key)
+            base_instance = self._live.get(key) if entry is None else None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                progress(f"Reusing loaded weights for {model_name}")
+            elif base_instance is not None:
+                entry = self._entries[key] = self._entry(base_instance)
+                progress(f"Reusing loaded weights for {model_name}")
+            else:
+                self._evict(keep=None, incoming_bytes=estimate_size_bytes(adm_config) or 0)
+                progress(f"Loading weights for {model_name}")
+                base_instance = hydra.utils.instantiate(adm_config.instance, recursive=True)
+                base_instance.draft_model = load_draft_model(adm_config, base_instance)
+                if base_instance.draft_model is not None:
+                    progress(f"Draft model {base_instance.draft_model.name_or_path} loaded")
+                progress("Weights loaded")
+                progress(f"Device placement done ({', '.join(_model_devices(base_instance))})")
+                self._live[key] = base_instance
+                entry = self._entries[key] = self._entry(base_instance)
+                # The estimate can be off, so check the budget again with the
+                # loaded size
+                self._evict(keep=key)
+
+            instance = copy.copy(entry['instance'])
+            entry['users'].add(instance)
+        for panel_key in PANEL_KEYS:
+            if panel_key in adm_config.instance:
+                value = adm_config.instance[panel_key]
+                if OmegaConf.is_config(value):
+                    value = hydra.utils.instantiate(value)
+                setattr(instance, panel_key, value)
+        return SimpleNamespace(instance=instance, config=adm_config)
+
+    @staticmethod
+    def _entry(base_instance):
+        return {
+            'instance': base_instance,
+            'size_bytes': _model_size_bytes(base_instance),
+            # Panel instances sharing the weights; the entry is in use
+            # while any is alive
+            'users': weakref.WeakSet(),
+        }
+
+    def _evict(self, keep, incoming_bytes=0):
+        while sum(e['size_bytes'] for e in self._entries.values()) + incoming_bytes > self.budget_bytes:
+            key = next((k for k, e in self._entries.items() if k != keep and not e['users']), None)
+            if key is None:
+                break
+            del self._entries[key]
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+
+MODEL_POOL = ModelPool()
+
+
+def get_adm(llm_backbone, adm_type, aligned, precision=None, device=None):
+    return MODEL_POOL.get(load_adm_config(adm_type, aligned, llm_backbone, precision, device))
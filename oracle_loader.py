@@ -0,0 +1,218 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import re
+
+CATALOG_SUFFIX = '.catalog'
+CATALOG_FORMAT_VERSION = 2
+
+# Tokens that matter for finding record boundaries; strings are consumed
+# whole so brackets inside them are never counted
+_TOKEN_RE = re.compile(rb'"(?:[^"\\]|\\.)*"|[\[\]{}]', re.DOTALL)
+
+
+def file_version(path):
+    stat = os.stat(path)
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+def file_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def record_probe_id(meta_info, probe_id_counts):
+    '''
+    Probe ID of a record from its state's meta_info. probe_id_counts is
+    shared by the records of one scenario so repeated IDs stay unique.
+    '''
+    probe_response = (meta_info or {}).get('probe_response')
+    if probe_response is not None:
+        probe_id = probe_response['probe_id']
+    else:
+        probe_id = 'N/A'
+
+    # Records without a probe response (e.g. the initial state of each
+    # scenario) would otherwise collide on 'N/A'
+    probe_id_counts[probe_id] = probe_id_counts.get(probe_id, 0) + 1
+    if probe_id_counts[probe_id] > 1:
+        probe_id = f"{probe_id} ({probe_id_counts[probe_id]})"
+    return probe_id
+
+
+def scan_record_offsets(path):
+    '''
+    Yield (start, end) byte offsets of each record in a top-level JSON
+    array without decoding the file
+    '''
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            depth = 0
+            start = None
+            for match in _TOKEN_RE.finditer(mm):
+                token = match.group()
+                if token[0] == ord('"'):
+                    continue
+                if token in (b'[', b'{'):
+                    if depth == 1:
+                        start = match.start()
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 1 and start is not None:
+                        yield start, match.end()
+                        start = None
+
+
+def build_catalog(path):
+    '''
+    Catalog of an oracle file: scenario IDs in file order and, per scenario,
+    each record's probe ID, byte offsets and character and action counts
+    '''
+    scenario_ids = []
+    probes = {}
+    probe_id_counts = {}
+    with open(path, 'rb') as f:
+        for start, end in scan_record_offsets(path):
+            f.seek(start)
+            # Records are decoded one at a time so memory is bounded by
+            # the largest record rather than the whole file
+            record = json.loads(f.read(end - start))
+            scenario_id = record['input']['scenario_id']
+            if scenario_id not in probes:
+                scenario_ids.append(scenario_id)
+                probes[scenario_id] = []
+                probe_id_counts[scenario_id] = {}
+
+            full_state = record['input'].get('full_state') or {}
+            probes[scenario_id].append({
+                'probe_id': record_probe_id(full_state.get('meta_info'), probe_id_counts[scenario_id]),
+                'offsets': [start, end],
+                'characters': len(full_state.get('characters') or []),
+                'actions': len(record['input'].get('choices') or []),
+            })
+
+    return {
+        'format': CATALOG_FORMAT_VERSION,
+        'version': file_version(path),
+        'sha256': file_hash(path),
+        'scenario_ids': scenario_ids,
+        'probes': probes,
+    }
+
+
+def _write_catalog(catalog_path, catalog):
+    try:
+        with open(f"{catalog_path}.tmp", 'w') as f:
+            json.dump(catalog, f)
+        os.replace(f"{catalog_path}.tmp", catalog_path)
+    except OSError:
+        # The cache is optional, e.g. when the dataset directory is
+        # read-only
+        pass
+
+
+def load_catalog(path, cache=True):
+    '''
+    Catalog of an oracle file, read from <path>.catalog when it is still
+    valid for the file and (re)built otherwise. A changed mtime alone (e.g.
+    after a checkout) only costs a hash of the file, not a rebuild.
+    '''
+    catalog_path = f"{path}{CATALOG_SUFFIX}"
+    if cache and os.path.exists(catalog_path):
+        try:
+            with open(catalog_path, 'r') as f:
+                catalog = json.load(f)
+        except (OSError, ValueError):
+            catalog = {}
+        if catalog.get('format') == CATALOG_FORMAT_VERSION:
+            if catalog.get('version') == file_version(path):
+                return catalog
+            if catalog.get('sha256') == file_hash(path):
+                catalog['version'] = file_version(path)
+                _write_catalog(catalog_path, catalog)
+                return catalog
+
+    catalog = build_catalog(path)
+    if cache:
+        _write_catalog(catalog_path, catalog)
+    return catalog
+
+
+class OracleDataset:
+    '''
+    Oracle input/output JSON file whose records are decoded lazily from the
+    byte offsets in its catalog
+    '''
+    def __init__(self, path, cache=True):
+        self.path = path
+        self.catalog = load_catalog(path, cache=cache)
+
+    @property
+    def version(self):
+        return self.catalog['version']
+
+    @property
+    def scenario_ids(self):
+        return self.catalog['scenario_ids']
+
+    def probes(self, scenario_id):
+        # Catalog entries of a scenario's records, in record order
+        return self.catalog['probes'].get(scenario_id, [])
+
+    def _read(self, f, probe):
+        start, end = probe['offsets']
+        f.seek(start)
+        return json.loads(f.read(end - start))
+
+    def read(self, probe):
+        # Decode the record of one catalog entry
+        with open(self.path, 'rb') as f:
+            return self._read(f, probe)
+
+    def record(self, scenario_id, probe_id):
+        for probe in self.probes(scenario_id):
+            if probe['probe_id'] == probe_id:
+                return self.read(probe)
+        raise KeyError((scenario_id, probe_id))
+
+    def records(self, scenario_id):
+        with open(self.path, 'rb') as f:
+            for probe in self.probes(scenario_id):
+                yield self._read(f, probe)
+
+    def __iter__(self):
+        for scenario_id in self.scenario_ids:
+            yield from self.records(scenario_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build the catalogs of oracle JSON files ahead of serving them')
+    parser.add_argument('paths', nargs='*',
+                        help='Oracle JSON files (default: every file in oracle-json-files/)')
+    parser.add_argument('--force', action='store_true', help='Rebuild catalogs that are still valid')
+    args = parser.parse_args()
+
+    paths = args.paths or sorted(
+        os.path.join('oracle-json-files', name) for name in os.listdir('oracle-json-files')
+        if name.endswith('.json'))
+    for path in paths:
+        if args.force:
+            catalog = build_catalog(path)
+            _write_catalog(f"{path}{CATALOG_SUFFIX}", catalog)
+        else:
+            catalog = load_catalog(path)
+        num_probes = sum(len(probes) for probes in catalog['probes'].values())
+        print(f"{path}: {len(catalog['scenario_ids'])} scenarios, {num_probes} probes")
+
+
+if __name__ == '__main__':
+    main()
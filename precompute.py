@@ -0,0 +1,94 @@
+'''
+Run every probe of the bundled datasets for each backbone, baseline and
+aligned with every alignment target the UI offers, into the precomputed
+results store that RUN MODEL answers unedited prompts from. Re-running
+resumes after the stored probes.
+
+    python precompute.py --llm-backbones mistralai/Mistral-7B-Instruct-v0.2
+'''
+import argparse
+import os
+
+from omegaconf import OmegaConf
+import torch
+
+from alignment_targets import alignment_target_name, load_alignment_target
+from app_layout import attributes, list_adms, list_llm_backbones
+from batch_eval import choose_actions, iter_probes
+from model_pool import PRECISIONS, get_adm
+from oracle_loader import OracleDataset
+from precomputed_results import PRECOMPUTED_RESULTS_PATH, PrecomputedResults, ResultKey, target_id
+
+DATASET_DIR = 'oracle-json-files'
+
+
+def ui_alignment_targets():
+    # The target configs the KDMA dropdown and slider can pick
+    return sorted({alignment_target_name(kdma, value) for kdma in attributes for value in (0, 1)})
+
+
+def precompute_dataset(store, dataset_path, adm, key, alignment_target, batch_size):
+    dataset = OracleDataset(dataset_path)
+    dataset_sha256 = dataset.catalog['sha256']
+    demo_kwargs = OmegaConf.to_container(adm.config.demo_kwargs)
+    completed = store.completed(key, dataset_sha256)
+
+    def flush(batch):
+        actions_taken = choose_actions(adm, batch, alignment_target, demo_kwargs)
+        store.put_many([
+            (key._replace(scenario_id=scenario_id, probe_id=probe.probe_id), dataset_sha256,
+             action_taken.action_id, action_taken.justification)
+            for (scenario_id, _, probe), action_taken in zip(batch, actions_taken)])
+        return len(batch)
+
+    num_done = 0
+    batch = []
+    for scenario_id, _, record, probe in iter_probes(dataset, completed):
+        batch.append((scenario_id, record, probe))
+        if len(batch) == batch_size:
+            num_done += flush(batch)
+            batch = []
+    if batch:
+        num_done += flush(batch)
+    print(f"{key.dataset} {key.llm_backbone} {'aligned' if key.aligned else 'baseline'} "
+          f"{key.alignment_target or '-'}: {num_done} probes run, {len(completed)} already stored")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--datasets', nargs='*',
+                        help='Oracle JSON files (default: every file in oracle-json-files/)')
+    parser.add_argument('--llm-backbones', nargs='+', default=list_llm_backbones())
+    parser.add_argument('--adm', default=list_adms()[0])
+    parser.add_argument('--alignment-targets', nargs='+', default=ui_alignment_targets(),
+                        help='Alignment target config names run with the aligned ADM')
+    parser.add_argument('--precision', choices=list(PRECISIONS), default=None,
+                        help='Precision the results are stored for, as chosen in the UI')
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--output', default=PRECOMPUTED_RESULTS_PATH)
+    args = parser.parse_args()
+
+    # Same torch determinism as the app so results match live generation
+    os.environ["CUBLAS_WORKSPACE_CONFIG"] = ":4096:8"
+    torch.use_deterministic_algorithms(True)
+
+    paths = args.datasets or sorted(
+        os.path.join(DATASET_DIR, name) for name in os.listdir(DATASET_DIR) if name.endswith('.json'))
+    store = PrecomputedResults(args.output)
+    for llm_backbone in args.llm_backbones:
+        # Baseline and aligned ADMs share the backbone's weights in the pool
+        for aligned, target_names in ((False, [None]), (True, args.alignment_targets)):
+            adm = get_adm(llm_backbone, args.adm, aligned, args.precision, args.device)
+            precision = args.precision or adm.config.get('precision')
+            for target_name in target_names:
+                alignment_target = load_alignment_target(target_name)
+                for path in paths:
+                    key = ResultKey(os.path.basename(path), None, None, llm_backbone, args.adm,
+                                    aligned, precision, target_id(alignment_target))
+                    precompute_dataset(store, path, adm, key, alignment_target, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
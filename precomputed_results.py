@@ -0,0 +1,89 @@
+from collections import namedtuple
+import os
+import sqlite3
+
+# Written by precompute.py; RUN MODEL answers unedited prompts from it
+PRECOMPUTED_RESULTS_PATH = os.environ.get('ALIGN_DEMO_PRECOMPUTED', 'precomputed/results.sqlite')
+
+# A result is keyed by the UI inputs that produce it: the dataset, scenario
+# and probe dropdowns, the panel's backbone, algorithm, Aligned checkbox and
+# precision, and the alignment target's id ('' without one). Unset
+# precisions are stored as ''.
+ResultKey = namedtuple('ResultKey', [
+    'dataset', 'scenario_id', 'probe_id', 'llm_backbone', 'adm_type', 'aligned', 'precision',
+    'alignment_target'])
+KEY_COLUMNS = ResultKey._fields
+
+
+def target_id(alignment_target):
+    if not alignment_target:
+        return ''
+    return str(alignment_target['id'])
+
+
+class PrecomputedResults:
+    '''
+    SQLite store of ADM results for whole datasets. Rows also hold the
+    dataset's content hash, so results of an older version of a dataset
+    are never served.
+    '''
+    def __init__(self, path=PRECOMPUTED_RESULTS_PATH):
+        self.path = path
+
+    def _connect(self):
+        # A connection per call keeps the store usable from Dash's threads
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS results ("
+            f"{', '.join(KEY_COLUMNS)}, dataset_sha256 TEXT, action_id TEXT, justification TEXT, "
+            f"PRIMARY KEY ({', '.join(KEY_COLUMNS)}))")
+        return conn
+
+    def get(self, key, dataset_sha256):
+        # Only read an existing store; the UI doesn't create one
+        if not os.path.exists(self.path):
+            return None
+        with self._connect() as conn:
+            row = conn.execute(
+                f"SELECT action_id, justification FROM results "
+                f"WHERE {' AND '.join(f'{c} = ?' for c in KEY_COLUMNS)} AND dataset_sha256 = ?",
+                (*_key_values(key), dataset_sha256)).fetchone()
+        if row is None:
+            return None
+        return {'action_id': row[0], 'justification': row[1]}
+
+    def completed(self, key, dataset_sha256):
+        '''
+        (scenario_id, probe_id) pairs stored for key's dataset and ADM
+        inputs; key's scenario_id and probe_id are ignored
+        '''
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        columns = [c for c in KEY_COLUMNS if c not in ('scenario_id', 'probe_id')]
+        values = dict(zip(KEY_COLUMNS, _key_values(key)))
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT scenario_id, probe_id FROM results "
+                f"WHERE {' AND '.join(f'{c} = ?' for c in columns)} AND dataset_sha256 = ?",
+                (*[values[c] for c in columns], dataset_sha256)).fetchall()
+        return set(rows)
+
+    def put_many(self, rows):
+        '''
+        Store (key, dataset_sha256, action_id, justification) rows
+        '''
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._connect() as conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO results VALUES ({', '.join('?' * (len(KEY_COLUMNS) + 3))})",
+                [(*_key_values(key), sha256, action_id, justification)
+                 for key, sha256, action_id, justification in rows])
+
+
+def _key_values(key):
+    return tuple('' if value is None else int(value) if isinstance(value, bool) else value
+                 for value in key)
+
+
+PRECOMPUTED_RESULTS = PrecomputedResults()
@@ -0,0 +1,92 @@
+from collections import OrderedDict
+import copy
+import os
+import threading
+import weakref
+
+# Prompt KV caches kept per loaded model; 0 disables prefix caching
+PREFIX_CACHE_ENTRIES = int(os.environ.get('ALIGN_DEMO_PREFIX_CACHE_ENTRIES', 4))
+# Shorter shared prefixes aren't worth copying a cache for
+MIN_PREFIX_TOKENS = 16
+
+
+def _common_prefix_length(a, b):
+    n = min(len(a), len(b))
+    mismatches = (a[:n] != b[:n]).nonzero()
+    return n if len(mismatches) == 0 else int(mismatches[0])
+
+
+class PrefixCache:
+    '''
+    Least recently used KV caches of previous prompts for one model. A new
+    prompt reuses the cache of the entry it shares the longest prefix with,
+    so after an edit near the end of the prompt only the changed tokens are
+    encoded.
+    '''
+    def __init__(self, max_entries=PREFIX_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, input_ids):
+        input_ids = input_ids.cpu()
+        with self._lock:
+            best_key, best_length = None, 0
+            for key, (token_ids, _) in self._entries.items():
+                length = _common_prefix_length(token_ids, input_ids)
+                if length > best_length:
+                    best_key, best_length = key, length
+
+            # At least one prompt token has to be run through the model to
+            # get the logits for the first generated token
+            best_length = min(best_length, len(input_ids) - 1)
+            if best_key is None or best_length < MIN_PREFIX_TOKENS:
+                return None
+
+            self._entries.move_to_end(best_key)
+            past_key_values = copy.deepcopy(self._entries[best_key][1])
+        past_key_values.crop(best_length)
+        return past_key_values
+
+    def store(self, input_ids, past_key_values):
+        if self.max_entries <= 0 or not hasattr(past_key_values, 'crop'):
+            return
+        input_ids = input_ids.cpu()
+        # Only the prompt part of the cache is reusable
+        past_key_values.crop(len(input_ids))
+        with self._lock:
+            key = tuple(input_ids.tolist())
+            self._entries[key] = (input_ids, past_key_values)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Caches go away with the model they were computed for
+_PREFIX_CACHES = weakref.WeakKeyDictionary()
+_PREFIX_CACHES_LOCK = threading.Lock()
+
+
+def get_prefix_cache(model):
+    with _PREFIX_CACHES_LOCK:
+        if model not in _PREFIX_CACHES:
+            _PREFIX_CACHES[model] = PrefixCache()
+        return _PREFIX_CACHES[model]
+
+
+def prefix_cache_kwargs(model, input_ids):
+    '''
+    generate() kwargs reusing the cached KV state of the longest matching
+    prompt prefix for a single (unpadded) prompt
+    '''
+    if PREFIX_CACHE_ENTRIES <= 0:
+        return {}
+    kwargs = {'return_dict_in_generate': True}
+    past_key_values = get_prefix_cache(model).lookup(input_ids)
+    if past_key_values is not None:
+        kwargs['past_key_values'] = past_key_values
+    return kwargs
@@ -0,0 +1,69 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+import threading
+
+from action_filtering import filter_actions
+
+# Upper bound on hydrated probes kept in memory across all datasets
+MAX_INDEXED_PROBES = 512
+
+# Hydrated probes keyed by (dataset, scenario_id, probe_id), least recently
+# used first. Probes are hydrated one at a time as they are chosen; probe
+# IDs come from the dataset catalog without hydrating anything.
+PROBE_INDEX = OrderedDict()
+# Dash callbacks read and evict from the index on concurrent threads
+_LOCK = threading.Lock()
+
+
+@dataclass
+class ProbeEntry:
+    probe_id: str
+    state: object
+    actions: list
+    actions_filtered: list
+    meta_info: dict
+
+
+def clear_dataset(dataset):
+    with _LOCK:
+        for key in [k for k in PROBE_INDEX if k[0] == dataset]:
+            del PROBE_INDEX[key]
+
+
+def hydrate_probe(record, probe_id):
+    '''
+    ProbeEntry of an oracle record ({'input', 'label', 'output'}) under its
+    probe_id from the dataset catalog
+    '''
+    # Imported on first hydration so listing datasets and probes doesn't
+    # load align_system
+    from align_system.utils.hydrate_state import hydrate_scenario_state
+
+    state, actions = hydrate_scenario_state(record['input'])
+    actions_filtered = filter_actions(state, actions)
+    meta_info = state.to_dict()['meta_info'] or {}
+
+    return ProbeEntry(
+        probe_id=probe_id,
+        state=state,
+        actions=actions,
+        actions_filtered=actions_filtered,
+        meta_info=meta_info,
+    )
+
+
+def index_probe(dataset, scenario_id, probe):
+    with _LOCK:
+        PROBE_INDEX[(dataset, scenario_id, probe.probe_id)] = probe
+        PROBE_INDEX.move_to_end((dataset, scenario_id, probe.probe_id))
+        while len(PROBE_INDEX) > MAX_INDEXED_PROBES:
+            PROBE_INDEX.popitem(last=False)
+
+
+def get_probe(dataset, scenario_id, probe_id):
+    # None if the probe hasn't been hydrated (or was evicted)
+    with _LOCK:
+        probe = PROBE_INDEX.get((dataset, scenario_id, probe_id))
+        if probe is not None:
+            PROBE_INDEX.move_to_end((dataset, scenario_id, probe_id))
+    return probe
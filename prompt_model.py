@@ -0,0 +1,179 @@
+import copy
+from dataclasses import dataclass, field
+import threading
+
+SYSTEM_PROMPT_ID = 'system_prompt'
+SITUATION_ID = 'unstructured'
+CHARACTER_FIELDS = ('unstructured', 'intent')
+
+
+class PromptEditError(ValueError):
+    pass
+
+
+@dataclass
+class PromptSection:
+    # id is None for the ADM's template text, which can't be edited
+    id: str
+    text: str
+
+
+@dataclass
+class StructuredPrompt:
+    '''
+    An ADM prompt split into template text and editable sections that map to
+    state fields: 'system_prompt', 'unstructured' (the situation) and
+    'characters.<i>.unstructured' / 'characters.<i>.intent'. The UI edits
+    the rendered prompt; parse recovers the sections from the template text
+    around them, so section text may contain blank lines and colons.
+    '''
+    sections: list
+    action_choices: str
+    values: dict = field(init=False)
+
+    def __post_init__(self):
+        self.values = {s.id: s.text for s in self.sections if s.id is not None}
+
+    def render(self):
+        return ''.join(s.text for s in self.sections)
+
+    def parse(self, text):
+        values = {}
+        pos = 0
+        pending_id = None
+        for i, section in enumerate(self.sections):
+            if section.id is not None:
+                pending_id = section.id
+                continue
+
+            if pending_id is None:
+                found = pos if text.startswith(section.text, pos) else -1
+            elif i == len(self.sections) - 1:
+                found = len(text) - len(section.text) if text.endswith(section.text) else -1
+                found = found if found >= pos else -1
+            else:
+                found = text.find(section.text, pos)
+            if found < 0:
+                raise PromptEditError(
+                    f"Template text {section.text.strip()!r} was edited; only the system prompt, "
+                    f"situation and character descriptions can be changed")
+
+            if pending_id is not None:
+                values[pending_id] = text[pos:found]
+                pending_id = None
+            pos = found + len(section.text)
+
+        if pending_id is not None:
+            values[pending_id] = text[pos:]
+        return values
+
+    def changes(self, values):
+        # Parsed sections whose text differs from the prompt as loaded
+        return {section_id: value for section_id, value in values.items()
+                if value != self.values[section_id]}
+
+
+def _field_sections(state):
+    # Editable state fields in the order the ADM prompt lays them out
+    yield SYSTEM_PROMPT_ID, None
+    for i, character in enumerate(state.characters):
+        for name in CHARACTER_FIELDS:
+            yield f"characters.{i}.{name}", getattr(character, name)
+    yield SITUATION_ID, state.unstructured
+
+
+def structure_prompt(prompt, state):
+    '''
+    Split an ADM prompt (as returned by get_dialog_texts) for a scenario
+    state into a StructuredPrompt. The last blank-line separated block holds
+    the action choices; fields whose text can't be found in the prompt are
+    left as template text.
+    '''
+    head, _, action_choices = prompt.rpartition('\n\n')
+
+    sections = []
+    pos = 0
+    for section_id, value in _field_sections(state):
+        if section_id == SYSTEM_PROMPT_ID:
+            # The system prompt is the text between [INST] and the first
+            # blank line
+            start = head.find('[INST]')
+            if start < 0:
+                continue
+            start += len('[INST]')
+            end = head.find('\n\n', start)
+            end = len(head) if end < 0 else end
+        else:
+            if not value:
+                continue
+            value = str(value).strip()
+            start = head.find(value, pos)
+            if start < 0:
+                continue
+            end = start + len(value)
+
+        sections.append(PromptSection(None, head[pos:start]))
+        sections.append(PromptSection(section_id, head[start:end]))
+        pos = end
+    sections.append(PromptSection(None, head[pos:]))
+
+    # Adjacent fields with no template text between them can't be told
+    # apart when parsing, so the later one is kept as template text
+    merged = []
+    for section in sections:
+        if section.id is not None and merged and merged[-1].id is not None:
+            section = PromptSection(None, section.text)
+        if section.id is None and merged and merged[-1].id is None:
+            merged[-1] = PromptSection(None, merged[-1].text + section.text)
+        elif section.id is not None or section.text:
+            merged.append(section)
+    return StructuredPrompt(merged, action_choices)
+
+
+def apply_changes(state, changes):
+    '''
+    State with changed sections applied. Only the changed characters are
+    copied; an unchanged state is returned as is and must not be mutated.
+    '''
+    changes = {k: v for k, v in changes.items() if k != SYSTEM_PROMPT_ID}
+    if not changes:
+        return state
+
+    state = copy.copy(state)
+    state.characters = list(state.characters)
+    copied = set()
+    for section_id, value in changes.items():
+        if section_id == SITUATION_ID:
+            state.unstructured = value
+            continue
+
+        _, i, name = section_id.split('.')
+        i = int(i)
+        if i not in copied:
+            state.characters[i] = copy.copy(state.characters[i])
+            copied.add(i)
+        setattr(state.characters[i], name, value)
+    return state
+
+
+# Structured prompt each panel last loaded, with the probe it was built for
+PANEL_PROMPTS = {}
+_LOCK = threading.Lock()
+
+
+def store_panel_prompt(panel, probe_key, structured):
+    with _LOCK:
+        PANEL_PROMPTS[panel] = (probe_key, structured)
+
+
+def get_panel_prompt(panel, probe_key):
+    entry = PANEL_PROMPTS.get(panel)
+    if entry is None or entry[0] != probe_key:
+        return None
+    return entry[1]
+
+
+def drop_session(session_id):
+    with _LOCK:
+        for panel in [p for p in PANEL_PROMPTS if p[0] == session_id]:
+            del PANEL_PROMPTS[panel]
@@ -0,0 +1,191 @@
+from collections import deque
+import os
+import threading
+import time
+import weakref
+
+from metrics import observe, span, use_traces
+
+# Generations run at once per model; more than one only helps if the model
+# has memory to spare for concurrent forward passes
+QUEUE_CONCURRENCY = int(os.environ.get('ALIGN_DEMO_QUEUE_CONCURRENCY', 1))
+# Requests waiting per model before new ones are rejected outright
+QUEUE_MAX_DEPTH = int(os.environ.get('ALIGN_DEMO_QUEUE_DEPTH', 8))
+# Most queued requests for one model merged into a single batched generation
+QUEUE_MAX_BATCH = int(os.environ.get('ALIGN_DEMO_QUEUE_MAX_BATCH', 8))
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    '''
+    A queued generation. generate(on_text, stop_event) produces the response
+    on its own, streaming text to the job. A job with a GenerationRun can
+    instead be micro-batched with other queued jobs for the same model, in
+    which case finish(action_taken) turns its chosen action into the
+    response.
+
+    status is one of 'queued', 'running', 'done', 'stopped' or 'error'.
+    Time spent queued and generating is recorded to trace (a
+    metrics.Trace) when given.
+    '''
+    def __init__(self, generate, run=None, finish=None, trace=None):
+        self.generate = generate
+        self.run = run
+        self.finish = finish
+        self.trace = trace
+        self.submitted = None
+        self.status = 'queued'
+        self.text = ''
+        self.response = None
+        self.stop = threading.Event()
+        self.done = threading.Event()
+        self.queue = None
+
+    def on_text(self, text):
+        self.text += text
+
+    def position(self):
+        # 1-based place in the model's queue, 0 once the job has started
+        if self.status != 'queued' or self.queue is None:
+            return 0
+        return self.queue.position(self)
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.response
+
+    def _complete(self, status, response=None):
+        self.response = response
+        self.status = status
+        self.done.set()
+
+
+class ModelQueue:
+    '''
+    FIFO of generation jobs for one model, run by up to `concurrency` worker
+    threads. When a worker picks up a batchable job, it takes the other
+    batchable jobs waiting behind it (up to max_batch) and runs them through
+    one run_batch(runs) call.
+    '''
+    def __init__(self, run_batch=None, concurrency=QUEUE_CONCURRENCY,
+                 max_depth=QUEUE_MAX_DEPTH, max_batch=QUEUE_MAX_BATCH):
+        self.run_batch = run_batch
+        self.concurrency = concurrency
+        self.max_depth = max_depth
+        self.max_batch = max_batch
+        self._pending = deque()
+        self._workers = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, job):
+        return self.submit_many([job])[0]
+
+    def submit_many(self, jobs):
+        '''
+        Queue jobs together so they can be batched with each other. Raises
+        QueueFull without queueing any of them if they don't all fit.
+        '''
+        with self._lock:
+            if len(self._pending) + len(jobs) > self.max_depth:
+                raise QueueFull(f"{len(self._pending)} requests already queued for this model")
+            for job in jobs:
+                job.queue = self
+                job.submitted = time.perf_counter()
+                self._pending.append(job)
+
+            # Workers are started on demand and exit once the queue drains
+            new_workers = min(self.concurrency - self._workers, len(self._pending))
+            self._workers += new_workers
+        for _ in range(new_workers):
+            threading.Thread(target=self._work, daemon=True).start()
+        return jobs
+
+    def position(self, job):
+        with self._lock:
+            try:
+                return self._pending.index(job) + 1
+            except ValueError:
+                return 0
+
+    def _take(self):
+        with self._lock:
+            if not self._pending:
+                self._workers -= 1
+                return None
+
+            batch = [self._pending.popleft()]
+            if batch[0].run is not None and self.run_batch is not None:
+                for job in list(self._pending):
+                    if len(batch) >= self.max_batch:
+                        break
+                    if job.run is not None:
+                        self._pending.remove(job)
+                        batch.append(job)
+
+            now = time.perf_counter()
+            for job in batch:
+                job.status = 'running'
+                observe('queue_wait', now - job.submitted, [] if job.trace is None else [job.trace])
+            return batch
+
+    def _work(self):
+        while True:
+            batch = self._take()
+            if batch is None:
+                return
+
+            # Jobs stopped while they waited never reach the model
+            for job in batch:
+                if job.stop.is_set():
+                    job._complete('stopped')
+            batch = [job for job in batch if not job.done.is_set()]
+            if not batch:
+                continue
+
+            with use_traces(*[job.trace for job in batch]), span('generation'):
+                if len(batch) == 1:
+                    self._run_single(batch[0])
+                else:
+                    self._run_batched(batch)
+
+    def _run_single(self, job):
+        try:
+            response = job.generate(job.on_text, job.stop)
+        except Exception as e:
+            job._complete('error', f"GENERATION FAILED:\n{e}")
+        else:
+            if response is None:
+                job._complete('stopped')
+            else:
+                job._complete('done', response)
+
+    def _run_batched(self, batch):
+        # A batched generation doesn't stream and runs to completion
+        try:
+            actions_taken = self.run_batch([job.run for job in batch])
+            responses = [job.finish(action_taken)
+                         for job, action_taken in zip(batch, actions_taken)]
+        except Exception as e:
+            for job in batch:
+                job._complete('error', f"GENERATION FAILED:\n{e}")
+        else:
+            for job, response in zip(batch, responses):
+                job._complete('done', response)
+
+
+# One queue per loaded model, shared by every panel and session using it
+_QUEUES = weakref.WeakKeyDictionary()
+_QUEUES_LOCK = threading.Lock()
+
+
+def get_model_queue(model, run_batch=None):
+    with _QUEUES_LOCK:
+        if model not in _QUEUES:
+            _QUEUES[model] = ModelQueue(run_batch)
+        return _QUEUES[model]
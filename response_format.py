@@ -0,0 +1,22 @@
+# Kept apart from app.py so scripts and benchmarks can format responses
+# without building the Dash app
+
+
+def format_response(actions_filtered, action_taken):
+    actions_filtered_dicts = [action.to_dict() for action in actions_filtered]
+    action_taken_dict = action_taken.to_dict()
+    for action_gt in actions_filtered_dicts:
+        if action_gt['action_id'] == action_taken_dict['action_id']:
+            chosen_action_gt = action_gt
+            break
+
+    chosen_action_gt = chosen_action_gt["unstructured"]
+    justification = action_taken.justification
+    if justification is None:
+        justification = "Not generated in choice-only mode, click JUSTIFY to generate it."
+    return (
+        f"ACTION CHOICE:\n"
+        f"{chosen_action_gt}"
+        f"\n\nJUSTIFICATION:\n"
+        f"{justification}"
+    )
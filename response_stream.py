@@ -0,0 +1,39 @@
+import threading
+
+# Latest request_queue.Job per panel key. Its 'text' accumulates the raw
+# generated text, 'response' is set once the generation finishes.
+STREAMS = {}
+_LOCK = threading.Lock()
+
+
+def start_stream(panel, queue, job):
+    '''
+    Queue the panel's job on its model's queue, buffering the text it
+    streams for the panel to poll. Returns False if the panel already has a
+    generation queued or running; raises request_queue.QueueFull if the
+    model's queue is full.
+    '''
+    with _LOCK:
+        stream = STREAMS.get(panel)
+        if stream is not None and stream.status in ('queued', 'running'):
+            return False
+        queue.submit(job)
+        STREAMS[panel] = job
+    return True
+
+
+def stop_stream(panel):
+    stream = STREAMS.get(panel)
+    if stream is not None:
+        stream.stop.set()
+
+
+def get_stream(panel):
+    return STREAMS.get(panel)
+
+
+def drop_session(session_id):
+    with _LOCK:
+        for panel in [p for p in STREAMS if p[0] == session_id]:
+            STREAMS[panel].stop.set()
+            del STREAMS[panel]
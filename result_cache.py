@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from omegaconf import OmegaConf
+
+RESULT_CACHE_PATH = os.environ.get('ALIGN_DEMO_RESULT_CACHE', '.cache/results.sqlite')
+# Least recently used results are evicted once the stored results exceed
+# this size
+RESULT_CACHE_MAX_MB = float(os.environ.get('ALIGN_DEMO_RESULT_CACHE_MB', 256))
+
+
+def result_key(adm_config, alignment_target, system_prompt, actions, demo_kwargs):
+    '''
+    Hash of everything that determines a (greedy, fixed seed) generation:
+    backbone and ADM config, alignment target, edited system prompt,
+    filtered action IDs and demo kwargs
+    '''
+    if OmegaConf.is_config(adm_config):
+        adm_config = OmegaConf.to_container(adm_config)
+    if OmegaConf.is_config(alignment_target):
+        alignment_target = OmegaConf.to_container(alignment_target)
+    if isinstance(system_prompt, list):
+        system_prompt = system_prompt[0]
+
+    key = {
+        'backbone': adm_config['instance']['model_name'],
+        'adm_config': adm_config,
+        'alignment_target': alignment_target,
+        'system_prompt': system_prompt,
+        'action_ids': [a.action_id for a in actions],
+        'demo_kwargs': demo_kwargs,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ResultCache:
+    '''
+    Disk-backed (SQLite) cache of ADM responses keyed by result_key
+    '''
+    def __init__(self, path=RESULT_CACHE_PATH, max_mb=RESULT_CACHE_MAX_MB):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024**2)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'key TEXT PRIMARY KEY, action_id TEXT, justification TEXT, '
+                'response TEXT, size INTEGER, last_access REAL)')
+
+    def _connect(self):
+        # A connection per call keeps the cache usable from Dash's threads
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT action_id, justification, response FROM results WHERE key = ?',
+                (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE results SET last_access = ? WHERE key = ?',
+                         (time.time(), key))
+        return {'action_id': row[0], 'justification': row[1], 'response': row[2]}
+
+    def put(self, key, action_id, justification, response):
+        size = len(key) + sum(len((v or '').encode()) for v in (action_id, justification, response))
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                (key, action_id, justification, response, size, time.time()))
+            self._evict(conn)
+
+    def _evict(self, conn):
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in conn.execute(
+                'SELECT key, size FROM results ORDER BY last_access').fetchall():
+            conn.execute('DELETE FROM results WHERE key = ?', (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+
+RESULT_CACHE = ResultCache()
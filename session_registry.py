@@ -0,0 +1,40 @@
+import os
+import threading
+import time
+import uuid
+
+import model_loader
+import prompt_model
+import response_stream
+
+# Sessions idle for longer than this drop their panels' ADMs, prompts and
+# streams; the backbones stay in the shared model pool
+SESSION_TTL_SECONDS = float(os.environ.get('ALIGN_DEMO_SESSION_TTL', 6 * 60 * 60))
+
+# Last time each browser session touched one of its panels
+SESSIONS = {}
+_LOCK = threading.Lock()
+
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+
+def panel_key(session_id, index):
+    '''
+    Key of a panel in the model loader and response stream registries. Each
+    browser session gets its own panels so sessions don't load over or
+    stream into each other's panels.
+    '''
+    now = time.monotonic()
+    with _LOCK:
+        SESSIONS[session_id] = now
+        expired = [s for s, last_seen in SESSIONS.items() if now - last_seen > SESSION_TTL_SECONDS]
+        for s in expired:
+            del SESSIONS[s]
+
+    for s in expired:
+        model_loader.drop_session(s)
+        prompt_model.drop_session(s)
+        response_stream.drop_session(s)
+    return (session_id, index)
@@ -0,0 +1,61 @@
+import json
+import os
+
+import pytest
+
+from oracle_loader import OracleDataset, build_catalog, load_catalog, scan_record_offsets
+
+DATASET_DIR = os.path.join(os.path.dirname(__file__), '..', 'oracle-json-files')
+DATASETS = sorted(os.path.join(DATASET_DIR, name) for name in os.listdir(DATASET_DIR)
+                  if name.endswith('.json'))
+
+
+@pytest.mark.parametrize('path', DATASETS, ids=os.path.basename)
+def test_record_offsets_match_json_load(path):
+    with open(path, 'rb') as f:
+        content = f.read()
+    records = [json.loads(content[start:end]) for start, end in scan_record_offsets(path)]
+    assert records == json.loads(content)
+
+
+@pytest.mark.parametrize('path', DATASETS, ids=os.path.basename)
+def test_dataset_reads_records_in_file_order(path):
+    with open(path) as f:
+        expected = json.load(f)
+    dataset = OracleDataset(path, cache=False)
+    assert list(dataset) == expected
+    assert dataset.scenario_ids == list(dict.fromkeys(r['input']['scenario_id'] for r in expected))
+
+
+def test_offsets_ignore_brackets_in_strings(tmp_path):
+    records = [{'text': 'a [b] {c} "d"', 'nested': [{'x': ']'}]}, {'text': '\\'}, []]
+    path = tmp_path / 'records.json'
+    path.write_text(json.dumps(records))
+    content = path.read_bytes()
+    assert [json.loads(content[start:end]) for start, end in scan_record_offsets(path)] == records
+
+
+def test_empty_file_has_no_records(tmp_path):
+    path = tmp_path / 'empty.json'
+    path.write_bytes(b'')
+    assert list(scan_record_offsets(path)) == []
+
+
+def test_catalog_is_cached_and_rebuilt_when_file_changes(tmp_path):
+    path = tmp_path / 'dataset.json'
+    with open(DATASETS[0], 'rb') as f:
+        path.write_bytes(f.read())
+
+    catalog = load_catalog(str(path))
+    assert os.path.exists(f"{path}.catalog")
+    assert load_catalog(str(path)) == catalog
+
+    # Touching the file only changes its version
+    os.utime(path, ns=(0, 0))
+    touched = load_catalog(str(path))
+    assert touched['sha256'] == catalog['sha256']
+    assert touched['probes'] == catalog['probes']
+
+    records = json.loads(path.read_text())
+    path.write_text(json.dumps(records[:1]))
+    assert load_catalog(str(path)) == build_catalog(str(path))
@@ -0,0 +1,76 @@
+from types import SimpleNamespace
+
+import pytest
+
+from fake_adm import FakeADM
+from prompt_model import (
+    SITUATION_ID,
+    SYSTEM_PROMPT_ID,
+    PromptEditError,
+    apply_changes,
+    structure_prompt,
+)
+
+
+def make_state():
+    characters = [SimpleNamespace(name='Casualty A', unstructured='Burn on left arm.', intent='no intent'),
+                  SimpleNamespace(name='Casualty B', unstructured='Shrapnel wound:\n\nbleeding.',
+                                  intent='intend major harm')]
+    return SimpleNamespace(characters=characters, unstructured='Two casualties after an explosion.')
+
+
+def make_prompt(state):
+    actions = [SimpleNamespace(unstructured='Treat Casualty A'),
+               SimpleNamespace(unstructured='Treat Casualty B')]
+    return FakeADM()._prompt(state, actions)
+
+
+def test_unedited_prompt_round_trips():
+    state = make_state()
+    prompt = make_prompt(state)
+    structured = structure_prompt(prompt, state)
+
+    rendered = structured.render()
+    assert rendered + '\n\n' + structured.action_choices == prompt
+    values = structured.parse(rendered)
+    assert values == structured.values
+    assert structured.changes(values) == {}
+    assert apply_changes(state, structured.changes(values)) is state
+
+
+def test_edits_apply_to_a_copy_of_the_state():
+    state = make_state()
+    structured = structure_prompt(make_prompt(state), state)
+
+    edited = (structured.render()
+              .replace('Two casualties after an explosion.', 'Three casualties:\n\nafter a fire.')
+              .replace('Burn on left arm.', 'Burn on right arm.'))
+    changes = structured.changes(structured.parse(edited))
+    assert changes == {SITUATION_ID: 'Three casualties:\n\nafter a fire.',
+                       'characters.0.unstructured': 'Burn on right arm.'}
+
+    new_state = apply_changes(state, changes)
+    assert new_state.unstructured == 'Three casualties:\n\nafter a fire.'
+    assert new_state.characters[0].unstructured == 'Burn on right arm.'
+    # Unchanged characters are shared, the original state is untouched
+    assert new_state.characters[1] is state.characters[1]
+    assert state.unstructured == 'Two casualties after an explosion.'
+    assert state.characters[0].unstructured == 'Burn on left arm.'
+
+
+def test_system_prompt_edit_leaves_state_alone():
+    state = make_state()
+    structured = structure_prompt(make_prompt(state), state)
+
+    edited = structured.render().replace(structured.values[SYSTEM_PROMPT_ID], 'Be brief.')
+    changes = structured.changes(structured.parse(edited))
+    assert changes == {SYSTEM_PROMPT_ID: 'Be brief.'}
+    assert apply_changes(state, changes) is state
+
+
+def test_template_edit_is_rejected():
+    state = make_state()
+    structured = structure_prompt(make_prompt(state), state)
+
+    with pytest.raises(PromptEditError):
+        structured.parse(structured.render().replace('SITUATION:', 'SCENE:'))
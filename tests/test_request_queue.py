@@ -0,0 +1,97 @@
+import threading
+
+import pytest
+
+from request_queue import Job, ModelQueue, QueueFull
+
+TIMEOUT = 10
+
+
+def blocking_job(release):
+    # Occupies the queue's worker until release is set
+    def generate(on_text, stop_event):
+        release.wait(TIMEOUT)
+        return 'first'
+    return Job(generate)
+
+
+def batchable_job(name, calls):
+    def generate(on_text, stop_event):
+        calls.append([name])
+        return name
+    return Job(generate, run=name, finish=lambda action_taken: f"{action_taken} done")
+
+
+def test_queued_runs_are_batched():
+    calls = []
+
+    def run_batch(runs):
+        calls.append(list(runs))
+        return [run.upper() for run in runs]
+
+    queue = ModelQueue(run_batch, concurrency=1, max_depth=8, max_batch=2)
+    release = threading.Event()
+    first = queue.submit(blocking_job(release))
+    jobs = queue.submit_many([batchable_job(name, calls) for name in ('a', 'b', 'c')])
+    assert [job.position() for job in jobs] == [1, 2, 3]
+    release.set()
+
+    assert first.wait(TIMEOUT) == 'first'
+    assert [job.wait(TIMEOUT) for job in jobs] == ['A done', 'B done', 'c']
+    # c runs on its own once the batch of a and b reached max_batch
+    assert calls == [['a', 'b'], ['c']]
+    assert all(job.status == 'done' for job in jobs)
+
+
+def test_full_queue_rejects_without_queueing():
+    queue = ModelQueue(concurrency=1, max_depth=2)
+    release = threading.Event()
+    running = queue.submit(blocking_job(release))
+    try:
+        # The running job has left the queue, so two more fit
+        queued = queue.submit_many([Job(lambda on_text, stop_event: 'x') for _ in range(2)])
+        with pytest.raises(QueueFull):
+            queue.submit(Job(lambda on_text, stop_event: 'y'))
+        with pytest.raises(QueueFull):
+            ModelQueue(max_depth=1).submit_many([Job(None), Job(None)])
+        assert len(queue) == 2
+    finally:
+        release.set()
+    assert running.wait(TIMEOUT) == 'first'
+    assert [job.wait(TIMEOUT) for job in queued] == ['x', 'x']
+
+
+def test_stopped_jobs_never_run():
+    queue = ModelQueue(concurrency=1)
+    release = threading.Event()
+    queue.submit(blocking_job(release))
+    calls = []
+    job = queue.submit(batchable_job('a', calls))
+    job.stop.set()
+    release.set()
+
+    assert job.done.wait(TIMEOUT)
+    assert job.status == 'stopped'
+    assert job.response is None
+    assert calls == []
+
+
+def test_stop_during_generation_and_errors():
+    def streaming(on_text, stop_event):
+        on_text('partial')
+        stop_event.wait(TIMEOUT)
+        return None
+
+    queue = ModelQueue(concurrency=1)
+    job = queue.submit(Job(streaming))
+    job.stop.set()
+    assert job.done.wait(TIMEOUT)
+    assert job.status == 'stopped'
+    assert job.text == 'partial'
+
+    def failing(on_text, stop_event):
+        raise RuntimeError('out of memory')
+
+    job = queue.submit(Job(failing))
+    assert 'out of memory' in job.wait(TIMEOUT)
+    assert job.status == 'error'
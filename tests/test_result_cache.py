@@ -0,0 +1,33 @@
+import itertools
+
+from result_cache import ResultCache
+import result_cache
+
+
+def test_least_recently_used_results_are_evicted(tmp_path, monkeypatch):
+    clock = itertools.count()
+    monkeypatch.setattr(result_cache.time, 'time', lambda: next(clock))
+    # Room for two results of this size
+    size = len('key0') + len('a') + len('why') + len('response')
+    cache = ResultCache(str(tmp_path / 'results.sqlite'), max_mb=2.5 * size / 1024**2)
+
+    cache.put('key0', 'a', 'why', 'response')
+    cache.put('key1', 'a', 'why', 'response')
+    assert cache.get('key0') == {'action_id': 'a', 'justification': 'why', 'response': 'response'}
+
+    # key1 was used least recently, so it makes room for key2
+    cache.put('key2', 'a', 'why', 'response')
+    assert cache.get('key1') is None
+    assert cache.get('key0') is not None
+    assert cache.get('key2') is not None
+
+
+def test_results_persist_and_replace(tmp_path):
+    path = str(tmp_path / 'results.sqlite')
+    ResultCache(path).put('key', 'a', None, 'first')
+    cache = ResultCache(path)
+    assert cache.get('key') == {'action_id': 'a', 'justification': None, 'response': 'first'}
+
+    cache.put('key', 'b', 'why', 'second')
+    assert cache.get('key')['response'] == 'second'
+    assert cache.get('missing') is None
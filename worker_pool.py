@@ -0,0 +1,243 @@
+import copy
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+# Devices for ADM worker processes, e.g. "cuda:0,cuda:1". When unset ADMs
+# run inside the Dash server process.
+WORKER_DEVICES = [d.strip() for d in os.environ.get('ALIGN_DEMO_WORKER_DEVICES', '').split(',') if d.strip()]
+# Seconds workers get to load their ADMs before the pool is failed
+WORKER_LOAD_TIMEOUT = float(os.environ.get('ALIGN_DEMO_WORKER_LOAD_TIMEOUT', 30 * 60))
+# How often the result reader checks that the workers are still alive
+WORKER_POLL_SECONDS = 5.0
+
+
+class WorkerError(RuntimeError):
+    pass
+
+
+def _worker_main(device, adm_spec, tasks, results):
+    # Load failures are reported to the pool instead of leaving it waiting
+    # for a worker that will never be ready
+    try:
+        # Heavy imports happen in the worker so each process initializes
+        # torch for its own device
+        import torch
+
+        from batch_eval import choose_actions, format_result
+        from model_pool import MODEL_POOL, load_adm_config
+        from oracle_loader import OracleDataset
+        from probe_index import hydrate_probe
+
+        os.environ["CUBLAS_WORKSPACE_CONFIG"] = ":4096:8"
+        torch.use_deterministic_algorithms(True)
+
+        # Baseline and aligned ADMs share the worker's weights; which one
+        # runs is set per task
+        llm_backbone, adm_type, precision = adm_spec
+        adm_config = load_adm_config(adm_type, False, llm_backbone, precision, device)
+        adm = MODEL_POOL.get(adm_config)
+    except Exception as e:
+        results.put((None, f"{type(e).__name__}: {e}", device))
+        return
+    results.put((None, None, device))
+
+    datasets = {}
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        task_id, kind, payload = task
+        try:
+            if kind == 'call':
+                method, kwargs, attrs = payload
+                instance = copy.copy(adm.instance)
+                for name, value in attrs.items():
+                    setattr(instance, name, value)
+                result = getattr(instance, method)(**kwargs)
+            elif kind == 'probes':
+                (dataset_path, scenario_id, record_indices, aligned,
+                 alignment_target, demo_kwargs, choice_only) = payload
+                if dataset_path not in datasets:
+                    datasets[dataset_path] = OracleDataset(dataset_path)
+                # Only the records in this batch are decoded and hydrated
+                dataset = datasets[dataset_path]
+                batch = []
+                for i in record_indices:
+                    entry = dataset.probes(scenario_id)[i]
+                    record = dataset.read(entry)
+                    batch.append((scenario_id, record, hydrate_probe(record, entry['probe_id'])))
+                instance = copy.copy(adm.instance)
+                instance.baseline = not aligned
+                actions_taken = choose_actions(SimpleNamespace(instance=instance), batch,
+                                               alignment_target, demo_kwargs, choice_only)
+                result = [format_result(os.path.basename(dataset_path), *probe, action_taken)
+                          for probe, action_taken in zip(batch, actions_taken)]
+            else:
+                raise ValueError(f"Unknown task kind {kind}")
+        except Exception as e:
+            # Exceptions from model code aren't always picklable
+            results.put((task_id, f"{type(e).__name__}: {e}", None))
+        else:
+            results.put((task_id, None, result))
+
+
+class _WorkerADMInstance:
+    '''
+    Stand-in for an ADM instance whose calls run in the worker pool, so the
+    app can use pooled ADMs like locally loaded ones
+    '''
+    def __init__(self, pool, aligned):
+        self._pool = pool
+        self.baseline = not aligned
+        self.system_ui_prompt = None
+
+    def _call(self, method, kwargs):
+        attrs = {'baseline': self.baseline}
+        if self.system_ui_prompt is not None:
+            attrs['system_ui_prompt'] = self.system_ui_prompt
+        return self._pool.submit('call', (method, kwargs, attrs)).result()
+
+    def get_dialog_texts(self, **kwargs):
+        return self._call('get_dialog_texts', kwargs)
+
+    def top_level_choose_action(self, **kwargs):
+        return self._call('top_level_choose_action', kwargs)
+
+
+class WorkerPool:
+    '''
+    One worker process per device, each owning an ADM instance for the same
+    (llm_backbone, adm_type, precision). Baseline and aligned tasks share the
+    workers, so each device holds one copy of the weights. Tasks go through
+    a shared queue so idle workers pick up the next one.
+    '''
+    def __init__(self, llm_backbone, adm_type, devices=None, precision=None):
+        self.devices = devices or WORKER_DEVICES or ['cpu']
+        ctx = multiprocessing.get_context('spawn')
+        self._tasks = ctx.Queue()
+        self._results = ctx.Queue()
+        self._futures = {}
+        self._task_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._num_ready = 0
+        # Set once a worker fails to load or dies; fails every task after it
+        self._error = None
+        self._closed = False
+
+        self._workers = [
+            ctx.Process(target=_worker_main,
+                        args=(device, (llm_backbone, adm_type, precision),
+                              self._tasks, self._results),
+                        daemon=True)
+            for device in self.devices]
+        for worker in self._workers:
+            worker.start()
+
+        threading.Thread(target=self._collect_results, daemon=True).start()
+
+    @property
+    def failed(self):
+        return self._error is not None
+
+    def _collect_results(self):
+        while not self._closed and self._error is None:
+            try:
+                task_id, error, result = self._results.get(timeout=WORKER_POLL_SECONDS)
+            except queue.Empty:
+                for device, worker in zip(self.devices, self._workers):
+                    if not worker.is_alive() and not self._closed:
+                        self._fail(f"ADM worker on {device} exited with code {worker.exitcode}")
+                        break
+                continue
+
+            if task_id is None:
+                if error is not None:
+                    self._fail(f"ADM worker on {result} failed to load: {error}")
+                    continue
+                # Worker finished loading its ADM
+                self._num_ready += 1
+                if self._num_ready == len(self._workers):
+                    self._ready.set()
+                continue
+
+            with self._lock:
+                future = self._futures.pop(task_id)
+            if error is not None:
+                future.set_exception(WorkerError(error))
+            else:
+                future.set_result(result)
+
+    def _fail(self, message):
+        # One dead worker fails the whole pool: its task may be lost, and
+        # the remaining workers are stopped so the pool can be restarted
+        with self._lock:
+            self._error = WorkerError(message)
+            futures, self._futures = self._futures, {}
+        for future in futures.values():
+            future.set_exception(self._error)
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.terminate()
+        self._ready.set()
+
+    def wait_ready(self, timeout=WORKER_LOAD_TIMEOUT):
+        '''
+        Wait for every worker to load its ADM. Raises WorkerError if a
+        worker fails or the load takes longer than timeout.
+        '''
+        if not self._ready.wait(timeout):
+            self._fail(f"ADM workers didn't load within {timeout:.0f} s")
+        if self._error is not None:
+            raise self._error
+        return True
+
+    def submit(self, kind, payload):
+        future = Future()
+        task_id = next(self._task_ids)
+        with self._lock:
+            if self._error is not None:
+                future.set_exception(self._error)
+                return future
+            self._futures[task_id] = future
+        self._tasks.put((task_id, kind, payload))
+        return future
+
+    def adm_instance(self, aligned):
+        return _WorkerADMInstance(self, aligned)
+
+    def map_probes(self, dataset_path, probe_chunks, aligned, alignment_target, demo_kwargs,
+                   choice_only=False):
+        '''
+        Shard (scenario_id, record_indices) chunks of a dataset across the
+        workers; returns futures in submission order
+        '''
+        return [self.submit('probes', (dataset_path, scenario_id, record_indices, aligned,
+                                       alignment_target, demo_kwargs, choice_only))
+                for scenario_id, record_indices in probe_chunks]
+
+    def close(self):
+        self._closed = True
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def get_worker_pool(llm_backbone, adm_type, precision=None):
+    key = (llm_backbone, adm_type, precision)
+    with _POOLS_LOCK:
+        # A failed pool is replaced, so loading again restarts its workers
+        if key not in _POOLS or _POOLS[key].failed:
+            _POOLS[key] = WorkerPool(llm_backbone, adm_type, precision=precision)
+        return _POOLS[key]